@@ -0,0 +1,216 @@
+import argparse
+import glob
+import gzip
+import json
+import os
+import re
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+# Aggregate statistics over every conversation in user_data/: messages per
+# day, active users this week, average history length and top hashtags.
+# Each user file (profile, message log and archived segments) is reduced to a small partial
+# aggregate in a process pool; partials are cached by the files' mtime and
+# size in user_data/analytics/partials.json, so a re-run only reprocesses
+# conversations that changed. Used by the GUI's Analytics tab and runnable
+# on its own:  python analytics.py --data-dir user_data
+
+CACHE_NAME = os.path.join("analytics", "partials.json")
+CHUNK_SIZE = 256
+
+# Log lines are written by beck.message_line as {"from": ..., "text": ...,
+# "timestamp": ...}. Quotes inside the text are escaped, so this pattern
+# cannot match inside it, and one findall covers a whole file.
+TURN = re.compile(rb'"from": "(\w+)".*?"timestamp": "(\d{4}-\d{2}-\d{2})')
+
+def file_signature(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return [0, 0]
+    return [st.st_mtime_ns, st.st_size]
+
+def conversation_signature(profile_path, log_path, archive_path):
+    # Compaction writes a segment (changing the directory's mtime) and cuts the log
+    return file_signature(profile_path) + file_signature(log_path) + file_signature(archive_path)
+
+def compute_partial(task):
+    # Runs in a pool worker: (key, profile, log, archive dir) -> (key, signature, partial)
+    key, profile_path, log_path, archive_path = task
+    signature = conversation_signature(profile_path, log_path, archive_path)
+    try:
+        with open(profile_path, 'r', encoding='utf-8') as f:
+            profile = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return key, signature, None
+
+    per_day = Counter()
+    history = 0
+    messages = profile.get('messages')
+    if messages is not None:
+        # Old-style file with the history inline
+        for message in messages:
+            day = str(message.get('timestamp') or '')[:10]
+            if day:
+                per_day[day] += 1
+        history = len(messages)
+    else:
+        try:
+            with open(log_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+        for segment in glob.glob(os.path.join(archive_path, "*.jsonl.gz")):
+            with gzip.open(segment, 'rb') as f:
+                data += f.read()
+        for _, day in TURN.findall(data):
+            per_day[day.decode('ascii')] += 1
+        history = data.count(b"\n")
+
+    return key, signature, {
+        'user_id': profile.get('user_id'),
+        'last_seen': profile.get('last_seen'),
+        'history': history,
+        'per_day': dict(per_day),
+        'hashtags': list(profile.get('hashtags') or []),
+    }
+
+def load_cache(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_cache(path, cache):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, separators=(',', ':'))
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def scan(data_dir, workers=None, mp_context=None, progress=None):
+    # Returns (partials by key, stats about the scan). progress(done, total)
+    # is called from this thread as results come in.
+    cache_path = os.path.join(data_dir, CACHE_NAME)
+    cache = load_cache(cache_path)
+    log_dir = os.path.join(data_dir, "logs")
+    archive_dir = os.path.join(data_dir, "archive")
+
+    partials = {}
+    stale = []
+    with os.scandir(data_dir) as it:
+        for entry in it:
+            if not entry.name.endswith('.json') or not entry.is_file():
+                continue
+            key = entry.name[:-len('.json')]
+            log_path = os.path.join(log_dir, f"{key}.jsonl")
+            archive_path = os.path.join(archive_dir, key)
+            cached = cache.get(key)
+            if cached and cached['sig'] == conversation_signature(entry.path, log_path, archive_path):
+                partials[key] = cached
+            else:
+                stale.append((key, entry.path, log_path, archive_path))
+
+    if stale:
+        total = len(stale)
+        if total < CHUNK_SIZE or workers == 1:
+            results = map(compute_partial, stale)
+            executor = None
+        else:
+            executor = ProcessPoolExecutor(max_workers=workers, mp_context=mp_context)
+            results = executor.map(compute_partial, stale, chunksize=CHUNK_SIZE)
+        try:
+            for done, (key, signature, partial) in enumerate(results, 1):
+                if partial is not None:
+                    partials[key] = {'sig': signature, **partial}
+                if progress and (done % 1000 == 0 or done == total):
+                    progress(done, total)
+        finally:
+            if executor:
+                executor.shutdown()
+
+    # Writing the cache back also drops conversations whose files are gone
+    if stale or len(partials) != len(cache):
+        save_cache(cache_path, partials)
+    return partials, {'files': len(partials), 'reprocessed': len(stale)}
+
+def aggregate(partials, days=30, top=10, now=None):
+    now = now or datetime.now()
+    week_ago = (now - timedelta(days=7)).isoformat()
+
+    per_day = Counter()
+    hashtags = Counter()
+    users = set()
+    active = set()
+    history = 0
+    for partial in partials.values():
+        per_day.update(partial['per_day'])
+        hashtags.update(partial['hashtags'])
+        users.add(partial['user_id'])
+        if (partial['last_seen'] or "") >= week_ago:
+            active.add(partial['user_id'])
+        history += partial['history']
+
+    day_list = [(now - timedelta(days=n)).date().isoformat() for n in range(days - 1, -1, -1)]
+    return {
+        'conversations': len(partials),
+        'users': len(users),
+        'active_this_week': len(active),
+        'messages': sum(per_day.values()),
+        'average_history': history / len(partials) if partials else 0.0,
+        'messages_per_day': [(day, per_day.get(day, 0)) for day in day_list],
+        'top_hashtags': hashtags.most_common(top),
+    }
+
+def bar(value, largest, width=40):
+    return "█" * (round(value / largest * width) if largest else 0)
+
+def format_report(totals):
+    lines = [
+        f"Conversations:        {totals['conversations']}",
+        f"Users:                {totals['users']}",
+        f"Active this week:     {totals['active_this_week']}",
+        f"Messages (all time):  {totals['messages']}",
+        f"Average history:      {totals['average_history']:.1f} messages",
+        "",
+        "Messages per day:",
+    ]
+    largest = max((n for _, n in totals['messages_per_day']), default=0)
+    for day, count in totals['messages_per_day']:
+        lines.append(f"  {day} {count:>8} {bar(count, largest)}")
+    lines += ["", "Top hashtags (users):"]
+    largest = max((n for _, n in totals['top_hashtags']), default=0)
+    for tag, count in totals['top_hashtags']:
+        lines.append(f"  #{tag:<20} {count:>6} {bar(count, largest)}")
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Aggregate analytics over all user data")
+    parser.add_argument("--data-dir", default="user_data")
+    parser.add_argument("--workers", type=int, default=None, help="pool size, default one per CPU")
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--json", action="store_true", help="print the totals as JSON")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    partials, stats = scan(args.data_dir, args.workers)
+    totals = aggregate(partials, args.days, args.top)
+    elapsed = time.perf_counter() - start
+    if args.json:
+        print(json.dumps(totals, indent=2))
+    else:
+        print(format_report(totals))
+        print(f"\nScanned {stats['files']} conversations in {elapsed:.1f}s "
+              f"({stats['reprocessed']} reprocessed, the rest from cache)")
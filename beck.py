@@ -1,26 +1,96 @@
+from __future__ import annotations
+
 import json
 import logging
 import re
 import asyncio
+import contextvars
+import glob
+import gzip
+import heapq
 import os
-from datetime import datetime
-from telegram import Update, MessageEntity
-from telegram.ext import (
-    Application,
-    CommandHandler,
-    MessageHandler,
-    filters,
-    ContextTypes,
-)
-from fireworks.client import Fireworks
+import random
+import multiprocessing
+import signal
+import zlib
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from queue import Empty
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from typing import TYPE_CHECKING
+
+# telegram and httpx are imported where they are used, so scripts that only
+# need the storage helpers (guiapp.py, migrate_user_data.py...) start fast
+if TYPE_CHECKING:
+    import httpx
+    from telegram import Update
+    from telegram.ext import Application, ContextTypes
 
 # ===== CONFIGURATION =====
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN", "   HERE   ")
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # "polling" or "webhook"
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # public base URL registered with Telegram
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")  # behind a reverse proxy by default
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # required once WEBHOOK_URL is set
+MAX_INFLIGHT_UPDATES = int(os.getenv("MAX_INFLIGHT_UPDATES", "64"))
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "0"))  # 0 = single process
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "30"))
 FIREWORKS_API_KEY = os.getenv("FIREWORKS_API_KEY", "   HERE   ")
+FIREWORKS_BASE_URL = os.getenv("FIREWORKS_BASE_URL", "https://api.fireworks.ai/inference/v1")
 MODEL = "accounts/fireworks/models/llama-v3p1-8b-instruct"
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))
+LLM_STREAM_IDLE = float(os.getenv("LLM_STREAM_IDLE", "10"))  # max gap between chunks once a stream has started
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE", "45"))  # whole call, retries and fallbacks included
+LLM_RETRIES = int(os.getenv("LLM_RETRIES", "2"))
+LLM_RETRY_BACKOFF = float(os.getenv("LLM_RETRY_BACKOFF", "0.5"))
+LLM_FALLBACK_MODELS = [m.strip() for m in os.getenv("LLM_FALLBACK_MODELS", "").split(",") if m.strip()]
+LLM_HEDGE_QUANTILE = float(os.getenv("LLM_HEDGE_QUANTILE", "0"))  # e.g. 0.95, 0 disables hedging
+BREAKER_THRESHOLD = int(os.getenv("BREAKER_THRESHOLD", "5"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "200"))
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "20"))
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_GROUP_RATE = float(os.getenv("SEND_GROUP_RATE", str(20 / 60)))
+SEND_BURST = 3
+SEND_MAX_RETRIES = 3
+TYPING_DELAY = float(os.getenv("TYPING_DELAY", "0.5"))
+PHOTO_RECHECK_TTL = float(os.getenv("PHOTO_RECHECK_TTL", str(24 * 3600)))
+BURST_WINDOW = float(os.getenv("BURST_WINDOW", "1.5"))
+CONVERSATION_IDLE_TIMEOUT = 60
 DATA_DIR = "user_data"
+LOG_DIR = os.path.join(DATA_DIR, "logs")
+ARCHIVE_DIR = os.path.join(DATA_DIR, "archive")
+COMPACT_INTERVAL = float(os.getenv("COMPACT_INTERVAL", "0"))  # seconds between compaction runs, 0 = off
+COMPACT_KEEP_TURNS = int(os.getenv("COMPACT_KEEP_TURNS", "500"))  # 0 = no count limit
+COMPACT_MAX_AGE_DAYS = float(os.getenv("COMPACT_MAX_AGE_DAYS", "90"))  # 0 = no age limit
+HISTORY_TURNS = int(os.getenv("HISTORY_TURNS", "50"))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2000"))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "200"))
+LOG_READ_BLOCK = 64 * 1024
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "1000"))
+WARMUP_USERS = int(os.getenv("WARMUP_USERS", "0"))  # most recently active users preloaded at startup, 0 = off
+WARMUP_BATCH = 100
+FLUSH_INTERVAL = float(os.getenv("FLUSH_INTERVAL", "5"))
 BLACKLIST_FILE = "blacklist.json"
+BLACKLIST_CHECK_INTERVAL = float(os.getenv("BLACKLIST_CHECK_INTERVAL", "5"))
+USER_RATE_PER_MIN = float(os.getenv("USER_RATE_PER_MIN", "6"))  # model replies per user, 0 = unlimited
+CHAT_RATE_PER_MIN = float(os.getenv("CHAT_RATE_PER_MIN", "20"))
+USER_DAILY_TOKENS = int(os.getenv("USER_DAILY_TOKENS", "50000"))  # prompt + completion, 0 = unlimited
+CHAT_DAILY_TOKENS = int(os.getenv("CHAT_DAILY_TOKENS", "500000"))
+USAGE_FILE = os.path.join(DATA_DIR, "limits", "usage.json")
+ENTITY_INDEX_FILE = os.path.join(DATA_DIR, "index", "entities.jsonl")
+ENTITY_LIMIT = int(os.getenv("ENTITY_LIMIT", "100"))  # per kind per user, oldest dropped first
 ADMIN_IDS = [  ] # HERE
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 disables the endpoint
 
 # ===== LOGGING =====
 logging.basicConfig(
@@ -29,8 +99,446 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ===== METRICS =====
+# Cheap in-process counters and histograms, exported in Prometheus text format
+# on METRICS_PORT (if set) and summarized by the /stats admin command.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket holding the q-th observation
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+class Metrics:
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    @contextmanager
+    def timer(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - start, stage=stage)
+
+    def gauge(self, name: str, read):
+        # `read` is called at scrape time, so gauges cost nothing on the hot path
+        self.gauges[name] = read
+
+    def error(self, kind: str):
+        self.inc("errors_total", kind=kind)
+
+    def render(self) -> str:
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"beck_{name}{format_labels(labels)} {value:g}")
+        for name, read in sorted(self.gauges.items()):
+            lines.append(f"beck_{name} {read():g}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f"beck_{name}_bucket{format_labels(labels + (('le', f'{bound:g}'),))} {cumulative}")
+            lines.append(f"beck_{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+            lines.append(f"beck_{name}_sum{format_labels(labels)} {histogram.sum:g}")
+            lines.append(f"beck_{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+metrics = Metrics()
+
+# ===== EMBEDDED HTTP =====
+# Just enough HTTP/1.1 for the metrics endpoint and the webhook receiver:
+# one request per connection, Content-Length bodies only. A client that
+# goes quiet mid-request is dropped after REQUEST_READ_TIMEOUT, so it cannot
+# hold a connection, or the server's shutdown, open forever.
+MAX_REQUEST_BODY = 1024 * 1024
+REQUEST_READ_TIMEOUT = 10  # seconds for the headers, and again for the body
+
+async def read_http_head(reader: asyncio.StreamReader) -> tuple:
+    request_line = (await reader.readline()).decode("latin-1").split()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return request_line, headers
+
+async def read_http_request(reader: asyncio.StreamReader) -> tuple:
+    request_line, headers = await asyncio.wait_for(read_http_head(reader), REQUEST_READ_TIMEOUT)
+    length = int(headers.get("content-length", 0))
+    if length > MAX_REQUEST_BODY:
+        raise ValueError(f"request body too large ({length} bytes)")
+    body = await asyncio.wait_for(reader.readexactly(length), REQUEST_READ_TIMEOUT) if length else b""
+    method, path = (request_line + ["", ""])[:2]
+    return method, path, headers, body
+
+async def write_http_response(writer: asyncio.StreamWriter, status: str, body: bytes = b"",
+                              content_type: str = "text/plain; charset=utf-8"):
+    writer.write(
+        f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+    )
+    await writer.drain()
+
+async def serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        method, path, _, _ = await read_http_request(reader)
+        if method == "GET" and path == "/metrics":
+            await write_http_response(writer, "200 OK", metrics.render().encode("utf-8"),
+                                      "text/plain; version=0.0.4")
+        else:
+            await write_http_response(writer, "404 Not Found", b"not found\n")
+    except Exception as e:
+        logger.error(f"Metrics endpoint error: {e}")
+    finally:
+        writer.close()
+
 # ===== FIREWORKS AI CLIENT =====
-fireworks = Fireworks(api_key=FIREWORKS_API_KEY)
+# One pooled HTTP client and one concurrency cap shared by every conversation.
+# Both are created lazily so they bind to the running event loop.
+_http_client = None
+_llm_semaphore = None
+
+def get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None:
+        import httpx
+        _http_client = httpx.AsyncClient(
+            base_url=FIREWORKS_BASE_URL,
+            headers={"Authorization": f"Bearer {FIREWORKS_API_KEY.strip()}"},
+            timeout=httpx.Timeout(LLM_TIMEOUT, connect=10.0),
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONCURRENCY,
+                max_keepalive_connections=LLM_MAX_CONCURRENCY
+            )
+        )
+    return _http_client
+
+def get_llm_semaphore() -> asyncio.Semaphore:
+    global _llm_semaphore
+    if _llm_semaphore is None:
+        _llm_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+    return _llm_semaphore
+
+async def close_http_client():
+    global _http_client, _llm_semaphore
+    if _http_client is not None:
+        await _http_client.aclose()
+    _http_client = None
+    _llm_semaphore = None
+
+async def chat_completion(messages: list, max_tokens: int = 200, temperature: float = 0.7) -> str:
+    payload = {
+        "messages": messages,
+        "max_tokens": max_tokens,
+        "temperature": temperature
+    }
+    return await backend.call(
+        lambda model, timeout: complete_once(model, payload, timeout),
+        "complete"
+    )
+
+async def complete_once(model: str, payload: dict, timeout: float) -> str:
+    # Waiting for a free slot counts against the attempt's timeout
+    response = await asyncio.wait_for(post_completion(model, payload), timeout=timeout)
+    response.raise_for_status()
+    data = response.json()
+    content = data["choices"][0]["message"]["content"]
+    record_usage(data.get("usage"), payload["messages"], content)
+    return content
+
+async def post_completion(model: str, payload: dict):
+    async with get_llm_semaphore():
+        with metrics.timer("model"):
+            return await get_http_client().post("/chat/completions", json={**payload, "model": model})
+
+async def stream_chat_completion(messages: list, max_tokens: int = 200, temperature: float = 0.7):
+    payload = {
+        "messages": messages,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "stream": True
+    }
+    # Retries, fallbacks and hedging apply until the first token arrives;
+    # once text has been yielded a failure is passed on to the caller
+    deltas, first = await backend.call(
+        lambda model, timeout: open_stream(model, payload, timeout),
+        "first_token",
+        discard=lambda result: result[0].aclose()
+    )
+    try:
+        yield first
+        async for delta in deltas:
+            yield delta
+    finally:
+        await deltas.aclose()
+
+async def open_stream(model: str, payload: dict, timeout: float) -> tuple:
+    # Starts one streamed attempt and returns it with its first delta
+    deltas = stream_once(model, payload, timeout)
+    try:
+        first = await deltas.__anext__()
+    except StopAsyncIteration:
+        raise ValueError("empty reply from model")
+    except BaseException:
+        await deltas.aclose()
+        raise
+    return deltas, first
+
+async def stream_once(model: str, payload: dict, timeout: float):
+    # timeout covers the wait for a slot and the first token; after that the
+    # stream only has to keep moving, each chunk within LLM_STREAM_IDLE
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    usage = None
+    content = []
+    semaphore = get_llm_semaphore()
+    await asyncio.wait_for(semaphore.acquire(), timeout=timeout)
+    try:
+        start = time.perf_counter()
+        try:
+            async with get_http_client().stream("POST", "/chat/completions", json={**payload, "model": model}) as response:
+                response.raise_for_status()
+                lines = response.aiter_lines()
+                while True:
+                    wait = LLM_STREAM_IDLE if content else deadline - loop.time()
+                    try:
+                        line = await asyncio.wait_for(lines.__anext__(), timeout=wait)
+                    except StopAsyncIteration:
+                        break
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    chunk = json.loads(data)
+                    usage = chunk.get("usage") or usage
+                    choices = chunk.get("choices") or [{}]
+                    delta = choices[0].get("delta", {}).get("content")
+                    if delta:
+                        if not content:
+                            metrics.observe("stage_seconds", time.perf_counter() - start, stage="model_first_token")
+                        content.append(delta)
+                        yield delta
+        finally:
+            metrics.observe("stage_seconds", time.perf_counter() - start, stage="model")
+    finally:
+        semaphore.release()
+    record_usage(usage, payload["messages"], "".join(content))
+
+def record_usage(usage: dict, messages: list, content: str):
+    # Falls back to the local estimate when the provider sends no usage block
+    if usage:
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        completion_tokens = usage.get("completion_tokens", 0)
+    else:
+        prompt_tokens = sum(count_tokens(m["content"]) for m in messages)
+        completion_tokens = count_tokens(content)
+    metrics.inc("model_requests_total")
+    metrics.inc("model_prompt_tokens_total", prompt_tokens)
+    metrics.inc("model_completion_tokens_total", completion_tokens)
+    owner = usage_owner.get()
+    if owner:
+        usage_limits.charge(*owner, prompt_tokens + completion_tokens)
+
+# ===== MODEL BACKEND =====
+# Every model call goes through ModelBackend.call, which tries MODEL and then
+# each of LLM_FALLBACK_MODELS in order. Per model, transient errors (timeouts,
+# connection errors, 429 and 5xx) are retried up to LLM_RETRIES times with
+# full-jitter exponential backoff, each attempt bounded by LLM_TIMEOUT and the
+# whole call by LLM_DEADLINE. A circuit breaker per model opens after
+# BREAKER_THRESHOLD consecutive transient failures, so calls skip that model
+# without waiting on it until a single probe succeeds after BREAKER_COOLDOWN.
+# With LLM_HEDGE_QUANTILE set, an attempt still running past that latency
+# quantile gets a duplicate request, and whichever finishes first wins.
+HEDGE_MIN_SAMPLES = 50
+
+class BackendUnavailable(Exception):
+    pass
+
+def is_transient(error: BaseException) -> bool:
+    import httpx
+    if isinstance(error, (asyncio.TimeoutError, httpx.TransportError)):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return False
+
+class CircuitBreaker:
+    def __init__(self, model: str):
+        self.model = model
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if self.probing else "open"
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if self.probing or time.monotonic() - self.opened_at < BREAKER_COOLDOWN:
+            return False
+        # Let one probe through; its outcome closes or reopens the breaker
+        self.probing = True
+        return True
+
+    def success(self):
+        if self.opened_at is not None:
+            logger.info(f"Circuit for {self.model} closed")
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        if self.probing or (self.opened_at is None and self.failures >= BREAKER_THRESHOLD):
+            if self.opened_at is None:
+                logger.warning(f"Circuit for {self.model} opened after {self.failures} failures")
+                metrics.inc("circuit_opened_total", model=self.model)
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+    def abandon(self):
+        # A cancelled probe proves nothing; let the next call probe again
+        self.probing = False
+
+class ModelBackend:
+    def __init__(self):
+        self.models = [MODEL] + LLM_FALLBACK_MODELS
+        self.breakers = {model: CircuitBreaker(model) for model in self.models}
+        self.latency = {"complete": Histogram(), "first_token": Histogram()}
+
+    def open_circuits(self) -> int:
+        return sum(1 for breaker in self.breakers.values() if breaker.opened_at is not None)
+
+    async def call(self, attempt, kind: str, discard=None):
+        # attempt(model, timeout) is awaited for each try; kind names the
+        # latency that hedging is based on ("complete" or "first_token")
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + LLM_DEADLINE
+        last_error = None
+        for model in self.models:
+            breaker = self.breakers[model]
+            for retry in range(LLM_RETRIES + 1):
+                if not breaker.allow():
+                    metrics.inc("model_fast_fail_total", model=model)
+                    break
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    breaker.abandon()
+                    raise last_error or asyncio.TimeoutError()
+                if retry:
+                    metrics.inc("model_retries_total", model=model)
+                start = loop.time()
+                try:
+                    result = await self.hedged(attempt, model, min(LLM_TIMEOUT, remaining), kind, discard)
+                except asyncio.CancelledError:
+                    breaker.abandon()
+                    raise
+                except Exception as e:
+                    last_error = e
+                    if not is_transient(e):
+                        # Not the provider's fault: no retry, but the next model may accept it
+                        breaker.abandon()
+                        logger.warning(f"Model {model} rejected the request: {e!r}")
+                        metrics.error("model_request")
+                        break
+                    breaker.failure()
+                    logger.warning(f"Model {model} attempt {retry + 1} failed: {e!r}")
+                    metrics.error("model_attempt")
+                    if retry < LLM_RETRIES:
+                        backoff = random.uniform(0, LLM_RETRY_BACKOFF * 2 ** retry)
+                        await asyncio.sleep(min(backoff, max(0.0, deadline - loop.time())))
+                    continue
+                breaker.success()
+                self.latency[kind].observe(loop.time() - start)
+                if model != self.models[0]:
+                    metrics.inc("model_fallbacks_total", model=model)
+                return result
+        raise last_error or BackendUnavailable("every model circuit is open")
+
+    def hedge_delay(self, kind: str):
+        histogram = self.latency[kind]
+        if not LLM_HEDGE_QUANTILE or histogram.count < HEDGE_MIN_SAMPLES:
+            return None
+        # Hedging while every slot is busy would only deepen the overload
+        if get_llm_semaphore().locked():
+            return None
+        return histogram.quantile(LLM_HEDGE_QUANTILE)
+
+    async def hedged(self, attempt, model: str, timeout: float, kind: str, discard=None):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        first = asyncio.ensure_future(attempt(model, timeout))
+        tasks = {first}
+        try:
+            delay = self.hedge_delay(kind)
+            if delay is not None and delay < timeout:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    metrics.inc("model_hedges_total", model=model)
+                    tasks.add(asyncio.ensure_future(attempt(model, timeout - (loop.time() - start))))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                winners = [task for task in done if not task.exception()]
+                if winners:
+                    if winners[0] is not first:
+                        metrics.inc("model_hedge_wins_total", model=model)
+                    for extra in winners[1:]:
+                        if discard:
+                            await discard(extra.result())
+                    return winners[0].result()
+                error = next(iter(done)).exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+backend = ModelBackend()
 
 # ===== SYSTEM PROMPT =====
 SYSTEM_PROMPT = '''
@@ -73,8 +581,14 @@ You are Guinevere Beck from [CHARACTER NAME] texting someone on Telegram. Follow
 '''
 
 # ===== DATA MANAGEMENT =====
+# Each conversation is stored as two files: the mutable profile in
+# user_data/<chat>_<user>.json and an append-only message log in
+# user_data/logs/<chat>_<user>.jsonl. In memory, "messages" only holds the
+# newest HISTORY_TURNS turns and is never written into the profile.
 def ensure_data_dir():
-    os.makedirs(DATA_DIR, exist_ok=True)
+    os.makedirs(LOG_DIR, exist_ok=True)
+    os.makedirs(os.path.dirname(USAGE_FILE), exist_ok=True)
+    os.makedirs(os.path.dirname(ENTITY_INDEX_FILE), exist_ok=True)
 
 def make_user_key(chat_id: int, user_id: int) -> str:
     return f"{chat_id}_{user_id}"
@@ -82,7 +596,196 @@ def make_user_key(chat_id: int, user_id: int) -> str:
 def get_user_file(user_key: str) -> str:
     return os.path.join(DATA_DIR, f"{user_key}.json")
 
-def load_user_data(chat_id: int, user_id: int) -> dict:
+def get_log_file(user_key: str) -> str:
+    return os.path.join(LOG_DIR, f"{user_key}.jsonl")
+
+def write_file_atomic(path: str, text: str) -> int:
+    # Write to a temp file in the same directory, then rename over the target,
+    # so readers and crashes only ever see the old or the new file
+    data = text.encode('utf-8') if isinstance(text, str) else text
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    return len(data)
+
+# Entity fields are ordered sets in memory (dicts with None values, oldest
+# first) and plain lists on disk
+ENTITY_FIELDS = {
+    "url": "links",
+    "phone_number": "phone_numbers",
+    "hashtag": "hashtags",
+    "mention": "mentions",
+}
+
+def entity_sets(data: dict) -> dict:
+    for field in ENTITY_FIELDS.values():
+        data[field] = dict.fromkeys(data.get(field) or ())
+    return data
+
+def profile_json(data: dict) -> str:
+    return json.dumps({
+        k: list(v) if k in ENTITY_FIELDS.values() else v
+        for k, v in data.items() if k != "messages"
+    }, ensure_ascii=False)
+
+def message_line(message: dict) -> str:
+    return json.dumps(message, ensure_ascii=False) + "\n"
+
+def read_recent_messages(user_key: str, limit: int) -> list:
+    # Reads the log backwards in blocks until it has `limit` lines,
+    # so the cost depends on the turns wanted, not on the history length
+    if limit <= 0:
+        return []
+    try:
+        with open(get_log_file(user_key), 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            data = b""
+            while position > 0 and data.count(b"\n") <= limit:
+                step = min(LOG_READ_BLOCK, position)
+                position -= step
+                f.seek(position)
+                data = f.read(step) + data
+    except FileNotFoundError:
+        return []
+
+    messages = []
+    for line in data.splitlines()[-limit:]:
+        try:
+            messages.append(json.loads(line))
+        except json.JSONDecodeError:
+            # First line of a partial block or a torn write
+            continue
+    return messages
+
+def read_all_messages(user_key: str) -> list:
+    # Archived turns first, then the live log
+    messages = read_archived_messages(user_key)
+    try:
+        with open(get_log_file(user_key), 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    messages.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return messages
+
+def migrate_user_file(path: str) -> bool:
+    # Moves the "messages" list of an old-style user file into its log.
+    # The log is rewritten, not appended to, so re-running after a crash
+    # between the two writes can't duplicate turns.
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if "messages" not in data:
+        return False
+    ensure_data_dir()
+    user_key = os.path.splitext(os.path.basename(path))[0]
+    write_file_atomic(get_log_file(user_key), "".join(message_line(m) for m in data["messages"]))
+    write_file_atomic(path, profile_json(data))
+    return True
+
+class UserCache:
+    # LRU of user records with dirty tracking. Only the flusher writes files:
+    # dirty records that fall out of the LRU wait in `evicted` until the next
+    # flush, so two writes of the same file can never race. New log lines are
+    # queued in `pending_lines` and appended by the same flusher. A record a
+    # turn or summary still holds across a model call is pinned: get() keeps
+    # returning that copy even after it leaves the LRU, so a newer message
+    # can't load a second copy from disk that the pinned one later overwrites.
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.records = OrderedDict()
+        self.evicted = {}
+        self.pinned = {}  # user_key -> [data, pin count]
+        self.dirty = set()
+        self.pending_lines = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_key: str):
+        if user_key in self.records:
+            self.records.move_to_end(user_key)
+            self.hits += 1
+            return self.records[user_key]
+        if user_key in self.evicted:
+            self.hits += 1
+            self.put(user_key, self.evicted.pop(user_key))
+            self.dirty.add(user_key)
+            return self.records[user_key]
+        if user_key in self.pinned:
+            self.hits += 1
+            self.put(user_key, self.pinned[user_key][0])
+            return self.records[user_key]
+        self.misses += 1
+        return None
+
+    def pin(self, user_key: str, data: dict):
+        self.pinned.setdefault(user_key, [data, 0])[1] += 1
+
+    def unpin(self, user_key: str):
+        entry = self.pinned[user_key]
+        entry[1] -= 1
+        if not entry[1]:
+            del self.pinned[user_key]
+
+    def put(self, user_key: str, data: dict):
+        self.records[user_key] = data
+        self.records.move_to_end(user_key)
+        while len(self.records) > self.max_size:
+            old_key, old_data = self.records.popitem(last=False)
+            if old_key in self.dirty:
+                self.dirty.discard(old_key)
+                self.evicted[old_key] = old_data
+
+    def mark_dirty(self, user_key: str, data: dict):
+        if self.records.get(user_key) is not data:
+            self.evicted.pop(user_key, None)
+            self.put(user_key, data)
+        self.dirty.add(user_key)
+
+    def append_line(self, user_key: str, line: str):
+        self.pending_lines.setdefault(user_key, []).append(line)
+
+    def take_dirty(self) -> tuple:
+        # Serialize on the caller's thread so the records can't change mid-dump.
+        # Each profile carries its record, so a failed write puts back the
+        # live object (the JSON has no "messages") rather than a rebuilt copy.
+        profiles = [(user_key, profile_json(self.records[user_key]), self.records[user_key])
+                    for user_key in self.dirty]
+        profiles += [(user_key, profile_json(data), data) for user_key, data in self.evicted.items()]
+        lines = [(user_key, "".join(batch)) for user_key, batch in self.pending_lines.items()]
+        self.dirty.clear()
+        self.evicted.clear()
+        self.pending_lines = {}
+        return profiles, lines
+
+    def restore_dirty(self, failed: tuple):
+        profiles, lines = failed
+        for user_key, _, data in profiles:
+            if user_key in self.records:
+                self.dirty.add(user_key)
+            else:
+                # A pinned copy is the one a running turn will write back
+                pinned = self.pinned.get(user_key)
+                self.evicted.setdefault(user_key, pinned[0] if pinned else data)
+        for user_key, text in lines:
+            self.pending_lines.setdefault(user_key, []).insert(0, text)
+
+user_cache = UserCache(USER_CACHE_SIZE)
+
+def read_user_file(chat_id: int, user_id: int) -> dict:
     user_key = make_user_key(chat_id, user_id)
     defaults = {
         "chat_id": chat_id,
@@ -94,38 +797,449 @@ def load_user_data(chat_id: int, user_id: int) -> dict:
         "is_bot": False,
         "chat_type": None,
         "profile_photo": None,
+        "profile_photo_checked": None,
         "first_seen": datetime.now().isoformat(),
         "last_seen": None,
         "links": [],
         "phone_numbers": [],
         "hashtags": [],
         "mentions": [],
-        "messages": [],
         "message_count": 0,
-        "entities_parsed": 0
+        "entities_parsed": 0,
+        "summary": None,
+        "summary_until": None
     }
     
+    path = get_user_file(user_key)
     try:
-        with open(get_user_file(user_key), 'r', encoding='utf-8') as f:
+        with open(path, 'r', encoding='utf-8') as f:
             data = json.load(f)
-            # Merge with defaults for new fields
-            for key in defaults:
-                if key not in data:
-                    data[key] = defaults[key]
-            return data
+        if "messages" in data:
+            # Old-style file with the history inline; convert it on first touch
+            migrate_user_file(path)
+        # Merge with defaults for new fields
+        for key in defaults:
+            if key not in data:
+                data[key] = defaults[key]
     except (FileNotFoundError, json.JSONDecodeError):
-        return defaults.copy()
+        data = defaults.copy()
+    entity_sets(data)
+    summary_until = data.get("summary_until") or ""
+    data["messages"] = [
+        m for m in read_recent_messages(user_key, HISTORY_TURNS)
+        if m.get("timestamp", "") > summary_until
+    ]
+    return data
+
+def load_user_data(chat_id: int, user_id: int) -> dict:
+    user_key = make_user_key(chat_id, user_id)
+    data = user_cache.get(user_key)
+    if data is None:
+        with metrics.timer("load"):
+            data = read_user_file(chat_id, user_id)
+        user_cache.put(user_key, data)
+    return data
 
 def save_user_data(data: dict):
-    ensure_data_dir()
+    # Write-behind: the record is only marked dirty here, the flusher persists it
+    user_cache.mark_dirty(make_user_key(data["chat_id"], data["user_id"]), data)
+
+def add_entities(data: dict, found: dict):
+    # found maps profile field -> values from one message. A value seen again
+    # moves to the newest end; past ENTITY_LIMIT the oldest is dropped.
+    user_key = make_user_key(data["chat_id"], data["user_id"])
+    for field, values in found.items():
+        seen = data[field]
+        indexed = field in entity_index.users
+        for value in values:
+            if value in seen:
+                del seen[value]
+            elif indexed:
+                entity_index.add(field, value, user_key)
+            seen[value] = None
+        while len(seen) > ENTITY_LIMIT:
+            dropped = next(iter(seen))
+            del seen[dropped]
+            if indexed:
+                entity_index.remove(field, dropped, user_key)
+
+def append_message(data: dict, sender: str, text: str):
+    message = {
+        "from": sender,
+        "text": text,
+        "timestamp": datetime.now().isoformat(),
+        "tokens": count_tokens(text)
+    }
+    data["messages"].append(message)
     user_key = make_user_key(data["chat_id"], data["user_id"])
+    user_cache.append_line(user_key, message_line(message))
+    user_cache.mark_dirty(user_key, data)
+
+_write_lock = threading.Lock()
+
+def write_user_payloads(payloads: tuple) -> tuple:
+    # Serialized so a shutdown flush can't overtake a flush still on a worker thread
+    profiles, lines = payloads
+    failed_profiles, failed_lines = [], []
+    written = 0
+    with _write_lock, metrics.timer("save"):
+        ensure_data_dir()
+        for user_key, text in lines:
+            try:
+                data = text.encode('utf-8')
+                with open(get_log_file(user_key), 'ab') as f:
+                    f.write(data)
+                written += len(data)
+            except Exception as e:
+                logger.error(f"Error appending messages for {user_key}: {e}")
+                metrics.error("save")
+                failed_lines.append((user_key, text))
+        for user_key, text, data in profiles:
+            try:
+                written += write_file_atomic(get_user_file(user_key), text)
+            except Exception as e:
+                logger.error(f"Error saving data for {user_key}: {e}")
+                metrics.error("save")
+                failed_profiles.append((user_key, text, data))
+        metrics.inc("disk_bytes_written_total", written)
+        metrics.inc("user_files_written_total", len(profiles))
+    return failed_profiles, failed_lines
+
+def flush_user_data():
+    failed = write_user_payloads(user_cache.take_dirty())
+    user_cache.restore_dirty(failed)
+    usage = usage_limits.snapshot()
+    if usage:
+        save_usage(usage)
+    journal = entity_index.take_pending()
+    if journal:
+        append_entity_journal(journal)
+
+async def flush_loop():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        profiles, lines = payloads = user_cache.take_dirty()
+        if profiles or lines:
+            failed = await loop.run_in_executor(None, write_user_payloads, payloads)
+            user_cache.restore_dirty(failed)
+        usage = usage_limits.snapshot()
+        if usage:
+            await loop.run_in_executor(None, save_usage, usage)
+        journal = entity_index.take_pending()
+        if journal:
+            await loop.run_in_executor(None, append_entity_journal, journal)
+
+def recent_user_keys(limit: int) -> list:
+    # Profiles are rewritten by the flush after every message, so their
+    # mtime orders conversations by last_seen without opening the files
+    candidates = []
+    with os.scandir(DATA_DIR) as it:
+        for entry in it:
+            if not entry.name.endswith(".json") or not entry.is_file():
+                continue
+            user_key = entry.name[:-len(".json")]
+            if not owns_key(user_key):
+                continue
+            try:
+                candidates.append((entry.stat().st_mtime_ns, user_key))
+            except FileNotFoundError:
+                continue
+    return [user_key for _, user_key in heapq.nlargest(limit, candidates)]
+
+def read_user_files(user_keys: list) -> list:
+    records = []
+    for user_key in user_keys:
+        chat_id, user_id = (int(part) for part in user_key.rsplit("_", 1))
+        records.append((user_key, read_user_file(chat_id, user_id)))
+    return records
+
+async def warm_up_cache(limit: int):
+    # Preloads the most recently active users' records and recent turns, so
+    # their first message after a restart skips the file reads
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    user_keys = await loop.run_in_executor(None, recent_user_keys, limit)
+    loaded = 0
+    for i in range(0, len(user_keys), WARMUP_BATCH):
+        records = await loop.run_in_executor(None, read_user_files, user_keys[i:i + WARMUP_BATCH])
+        for user_key, data in records:
+            # A message may have loaded the record meanwhile, or a running turn
+            # may hold it pinned after it left the LRU; that copy wins
+            if (user_key not in user_cache.records and user_key not in user_cache.evicted
+                    and user_key not in user_cache.pinned):
+                user_cache.put(user_key, data)
+                loaded += 1
+    metrics.inc("warmup_records_total", loaded)
+    logger.info(f"Warmed up {loaded} user records in {time.perf_counter() - start:.1f}s")
+
+# ===== ARCHIVE =====
+# Compaction moves the old turns of a log into gzip segments under
+# user_data/archive/<chat>_<user>/, named after their first turn's timestamp
+# so they sort oldest first. The live log keeps the newest turns, the
+# profile keeps the summary, and turns still inside the bot's context
+# window (newer than summary_until) are never archived, so load_user_data
+# sees the same record before and after. The segment is written before the
+# log is cut: re-running after a crash in between rewrites the same segment
+# instead of duplicating turns.
+SHARD = None  # (index, workers) in a worker process, which only compacts its own conversations
+
+def get_archive_dir(user_key: str) -> str:
+    return os.path.join(ARCHIVE_DIR, user_key)
+
+def segment_name(timestamp: str) -> str:
+    return re.sub(r"\D", "", timestamp).ljust(20, "0") + ".jsonl.gz"
+
+def read_archived_messages(user_key: str) -> list:
+    messages = []
+    for path in sorted(glob.glob(os.path.join(get_archive_dir(user_key), "*.jsonl.gz"))):
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    messages.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    return messages
+
+def line_timestamp(line: bytes) -> str:
     try:
-        with open(get_user_file(user_key), 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        return json.loads(line).get("timestamp") or ""
+    except (json.JSONDecodeError, AttributeError):
+        return ""
+
+def compact_conversation(user_key: str, keep_turns: int, max_age_days: float, now: datetime = None) -> int:
+    # Archives turns beyond the newest keep_turns or older than max_age_days
+    # and returns how many were moved
+    try:
+        with open(get_log_file(user_key), 'rb') as f:
+            lines = f.read().splitlines(keepends=True)
+    except FileNotFoundError:
+        return 0
+    timestamps = [line_timestamp(line) for line in lines]
+
+    split = max(0, len(lines) - keep_turns) if keep_turns else 0
+    if max_age_days:
+        cutoff = ((now or datetime.now()) - timedelta(days=max_age_days)).isoformat()
+        old = 0
+        while old < len(lines) and timestamps[old] < cutoff:
+            old += 1
+        split = max(split, old)
+
+    try:
+        with open(get_user_file(user_key), 'r', encoding='utf-8') as f:
+            summary_until = json.load(f).get("summary_until") or ""
+    except (FileNotFoundError, json.JSONDecodeError):
+        summary_until = ""
+    for i in range(max(0, len(lines) - HISTORY_TURNS), len(lines)):
+        if timestamps[i] > summary_until:
+            split = min(split, i)
+            break
+    if split <= 0:
+        return 0
+
+    archived = b"".join(line if line.endswith(b"\n") else line + b"\n" for line in lines[:split])
+    first = next((t for t in timestamps[:split] if t), "0")
+    os.makedirs(get_archive_dir(user_key), exist_ok=True)
+    written = write_file_atomic(os.path.join(get_archive_dir(user_key), segment_name(first)),
+                                gzip.compress(archived, mtime=0))
+    write_file_atomic(get_log_file(user_key), b"".join(lines[split:]))
+    metrics.inc("turns_archived_total", split)
+    metrics.inc("archive_bytes_written_total", written)
+    return split
+
+def compact_user_data(keep_turns: int = None, max_age_days: float = None) -> tuple:
+    # Returns (conversations compacted, turns archived)
+    keep_turns = COMPACT_KEEP_TURNS if keep_turns is None else keep_turns
+    max_age_days = COMPACT_MAX_AGE_DAYS if max_age_days is None else max_age_days
+    conversations = turns = 0
+    for path in glob.glob(os.path.join(LOG_DIR, "*.jsonl")):
+        user_key = os.path.basename(path)[:-len(".jsonl")]
+        if SHARD and shard_of_key(user_key, SHARD[1]) != SHARD[0]:
+            continue
+        try:
+            # Holding the write lock keeps the flusher from appending mid-rewrite
+            with _write_lock, metrics.timer("compact"):
+                archived = compact_conversation(user_key, keep_turns, max_age_days)
+        except Exception as e:
+            logger.error(f"Error compacting {user_key}: {e}")
+            metrics.error("compact")
+            continue
+        if archived:
+            conversations += 1
+            turns += archived
+    return conversations, turns
+
+async def compact_loop():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(COMPACT_INTERVAL)
+        conversations, turns = await loop.run_in_executor(None, compact_user_data)
+        if turns:
+            logger.info(f"Archived {turns} turns from {conversations} conversations")
+
+# ===== ENTITY INDEX =====
+# Reverse of the per-user hashtag and mention sets: value -> user keys, so
+# "who used #x" needs no scan of user_data/. add_entities keeps it in step
+# with the records; every change is queued as a journal line and appended
+# to ENTITY_INDEX_FILE by the flusher. On startup the journal is replayed
+# (and rewritten when it is mostly stale), or rebuilt from the profiles
+# if it does not exist yet. In multi-process mode each worker keeps its own
+# journal, named after its index and the worker count: when BOT_WORKERS
+# changes, keys move between workers, so the new layout's journals are
+# rebuilt and the old layout's are removed.
+class EntityIndex:
+    def __init__(self):
+        self.users = {"hashtags": {}, "mentions": {}}
+        self.pending = []
+
+    def apply(self, op: str, kind: str, value: str, user_key: str) -> bool:
+        users = self.users[kind]
+        if op == "+":
+            keys = users.setdefault(value, set())
+            if user_key in keys:
+                return False
+            keys.add(user_key)
+        else:
+            keys = users.get(value)
+            if not keys or user_key not in keys:
+                return False
+            keys.discard(user_key)
+            if not keys:
+                del users[value]
+        return True
+
+    def add(self, kind: str, value: str, user_key: str):
+        if self.apply("+", kind, value, user_key):
+            self.pending.append(json.dumps(["+", kind, value, user_key], ensure_ascii=False) + "\n")
+
+    def remove(self, kind: str, value: str, user_key: str):
+        if self.apply("-", kind, value, user_key):
+            self.pending.append(json.dumps(["-", kind, value, user_key], ensure_ascii=False) + "\n")
+
+    def lookup(self, kind: str, value: str) -> list:
+        return sorted(self.users[kind].get(value, ()))
+
+    def top(self, kind: str, count: int) -> list:
+        return heapq.nlargest(count, ((len(keys), value) for value, keys in self.users[kind].items()))
+
+    def size(self) -> int:
+        return sum(len(keys) for users in self.users.values() for keys in users.values())
+
+    def replay(self, path: str, owned=None) -> int:
+        # Returns the number of journal lines read
+        lines = 0
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                lines += 1
+                try:
+                    op, kind, value, user_key = json.loads(line)
+                except (json.JSONDecodeError, ValueError):
+                    continue
+                if kind in self.users and (owned is None or owned(user_key)):
+                    self.apply(op, kind, value, user_key)
+        return lines
+
+    def dump(self) -> str:
+        return "".join(
+            json.dumps(["+", kind, value, user_key], ensure_ascii=False) + "\n"
+            for kind, users in self.users.items()
+            for value, keys in users.items()
+            for user_key in sorted(keys)
+        )
+
+    def take_pending(self) -> str:
+        text = "".join(self.pending)
+        self.pending = []
+        return text
+
+def owns_key(user_key: str) -> bool:
+    return not SHARD or shard_of_key(user_key, SHARD[1]) == SHARD[0]
+
+def entity_index_file(worker: int = None, workers: int = None) -> str:
+    name = "entities.jsonl" if worker is None else f"entities-{worker}-of-{workers}.jsonl"
+    return os.path.join(DATA_DIR, "index", name)
+
+def entity_index_files(workers: int) -> list:
+    # Every journal of one layout; 0 workers is the single-process journal
+    if not workers:
+        return [entity_index_file()]
+    return [entity_index_file(i, workers) for i in range(workers)]
+
+def latest_entity_index_files() -> list:
+    # For readers outside the bot: the layout of the journal written last
+    written = []
+    for path in glob.glob(os.path.join(DATA_DIR, "index", "entities*.jsonl")):
+        try:
+            written.append((os.path.getmtime(path), path))
+        except FileNotFoundError:
+            continue
+    if not written:
+        return []
+    match = re.search(r"-of-(\d+)\.jsonl$", max(written)[1])
+    return entity_index_files(int(match.group(1)) if match else 0)
+
+def remove_stale_entity_journals():
+    current = set(entity_index_files(SHARD[1] if SHARD else 0))
+    for path in glob.glob(os.path.join(DATA_DIR, "index", "entities*.jsonl")):
+        if path not in current:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # another worker got to it first
+
+def load_entity_index():
+    # Runs once at startup, before the flusher appends anything
+    remove_stale_entity_journals()
+    try:
+        lines = entity_index.replay(ENTITY_INDEX_FILE, owns_key)
+    except FileNotFoundError:
+        rebuild_entity_index()
+        return
+    if lines > 2 * entity_index.size() + 1000:
+        write_file_atomic(ENTITY_INDEX_FILE, entity_index.dump())
+
+def rebuild_entity_index():
+    for path in glob.glob(os.path.join(DATA_DIR, "*.json")):
+        user_key = os.path.basename(path)[:-len(".json")]
+        if not owns_key(user_key):
+            continue
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            continue
+        for kind in entity_index.users:
+            for value in data.get(kind) or ():
+                entity_index.apply("+", kind, value, user_key)
+    ensure_data_dir()
+    write_file_atomic(ENTITY_INDEX_FILE, entity_index.dump())
+    logger.info(f"Rebuilt the entity index from user files ({entity_index.size()} entries)")
+
+def append_entity_journal(text: str):
+    try:
+        with open(ENTITY_INDEX_FILE, 'a', encoding='utf-8') as f:
+            f.write(text)
     except Exception as e:
-        logger.error(f"Error saving data for {user_key}: {e}")
+        logger.error(f"Failed to append to the entity index: {e}")
+        metrics.error("save")
+        entity_index.pending.insert(0, text)
+
+def read_entity_index(paths: list) -> EntityIndex:
+    # A read-only copy from the journals on disk, for processes that don't own them
+    index = EntityIndex()
+    for path in paths:
+        try:
+            index.replay(path)
+        except FileNotFoundError:
+            continue
+    return index
+
+entity_index = EntityIndex()
 
 # ===== BLACKLIST =====
+# The blacklist lives in memory as a set. /ban and /unban update it in place
+# and save atomically; edits made to the file by hand are picked up by a
+# background check of its inode/mtime/size, so lookups never touch the disk.
 def load_blacklist() -> list:
     try:
         with open(BLACKLIST_FILE, 'r', encoding='utf-8') as f:
@@ -136,43 +1250,687 @@ def load_blacklist() -> list:
 
 def save_blacklist(blacklisted_ids: list):
     try:
-        with open(BLACKLIST_FILE, 'w', encoding='utf-8') as f:
-            json.dump({'blacklisted_ids': blacklisted_ids}, f, ensure_ascii=False, indent=2)
+        write_file_atomic(
+            BLACKLIST_FILE,
+            json.dumps({'blacklisted_ids': blacklisted_ids}, ensure_ascii=False, indent=2)
+        )
     except Exception as e:
         logger.error(f"Error saving blacklist: {e}")
 
+def blacklist_signature():
+    try:
+        st = os.stat(BLACKLIST_FILE)
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        return None
+
+class Blacklist:
+    def __init__(self):
+        self.ids = set()
+        self.signature = False
+
+    def refresh(self):
+        signature = blacklist_signature()
+        if signature != self.signature:
+            self.ids = set(load_blacklist())
+            self.signature = signature
+
+    def add(self, user_id: int) -> bool:
+        self.refresh()
+        if user_id in self.ids:
+            return False
+        self.ids.add(user_id)
+        self.save()
+        return True
+
+    def remove(self, user_id: int) -> bool:
+        self.refresh()
+        if user_id not in self.ids:
+            return False
+        self.ids.discard(user_id)
+        self.save()
+        return True
+
+    def save(self):
+        save_blacklist(sorted(self.ids))
+        self.signature = blacklist_signature()
+
+blacklist = Blacklist()
+
 def is_blacklisted(user_id: int) -> bool:
-    return user_id in load_blacklist()
+    return user_id in blacklist.ids
 
-# ===== AI FUNCTIONS =====
-def get_ai_response(user_data: dict, user_message: str) -> str:
+async def blacklist_watch_loop():
+    while True:
+        await asyncio.sleep(BLACKLIST_CHECK_INTERVAL)
+        try:
+            blacklist.refresh()
+        except Exception as e:
+            logger.error(f"Blacklist reload error: {e}")
+
+# ===== CONTEXT WINDOW =====
+# The prompt is the system prompt, a rolling summary of older turns and as
+# many of the newest turns as fit in CONTEXT_TOKEN_BUDGET. Turns that no
+# longer fit leave user_data["messages"] and are folded into the summary by
+# a background model call, so the prompt never grows with the history.
+SUMMARY_PROMPT = (
+    "You keep running notes about a Telegram conversation between Beck and a user. "
+    "Update the notes with the new messages. Keep names, facts about the user, "
+    "plans and the emotional tone. Reply with the updated notes only, at most a few sentences."
+)
+summary_tasks = {}
+pending_summary_turns = {}
+
+def count_tokens(text: str) -> int:
+    # Rough estimate (about 4 characters per token plus per-message overhead),
+    # good enough for budgeting without shipping a tokenizer
+    return len(text) // 4 + 4
+
+def message_tokens(message: dict) -> int:
+    tokens = message.get("tokens")
+    if tokens is None:
+        tokens = message["tokens"] = count_tokens(message["text"])
+    return tokens
+
+def build_context(user_data: dict, user_message: str) -> tuple:
+    # Returns the chat history for the model and the turns evicted from it
     history = [{"role": "system", "content": SYSTEM_PROMPT}]
-    for msg in user_data.get("messages", []):
-        history.append({"role": msg["from"], "content": msg["text"]})
+    budget = CONTEXT_TOKEN_BUDGET - count_tokens(SYSTEM_PROMPT) - count_tokens(user_message)
+    summary = user_data.get("summary")
+    if summary:
+        history.append({"role": "system", "content": f"Earlier in this conversation: {summary}"})
+        budget -= count_tokens(history[-1]["content"])
+
+    messages = user_data.get("messages", [])
+    keep = len(messages)
+    while keep > 0 and budget - message_tokens(messages[keep - 1]) >= 0:
+        keep -= 1
+        budget -= message_tokens(messages[keep])
+    overflow = messages[:keep]
+    if overflow:
+        del messages[:keep]
+
+    for msg in messages:
+        role = "assistant" if msg["from"] == "bot" else msg["from"]
+        history.append({"role": role, "content": msg["text"]})
     history.append({"role": "user", "content": user_message})
+    return history, overflow
 
+def prepare_history(user_data: dict, user_message: str) -> list:
+    history, overflow = build_context(user_data, user_message)
+    if overflow:
+        schedule_summary(user_data, overflow)
+    return history
+
+def schedule_summary(user_data: dict, turns: list):
+    user_key = make_user_key(user_data["chat_id"], user_data["user_id"])
+    pending_summary_turns.setdefault(user_key, []).extend(turns)
+    if user_key not in summary_tasks:
+        summary_tasks[user_key] = asyncio.create_task(summarize_pending(user_key, user_data))
+
+async def summarize_pending(user_key: str, user_data: dict):
+    # Only the newly evicted turns are sent, together with the previous summary
+    user_cache.pin(user_key, user_data)
     try:
-        response = fireworks.chat.completions.create(
-            model=MODEL,
-            messages=history,
-            max_tokens=200,
-            temperature=0.7
-        )
-        return response.choices[0].message.content
+        while pending_summary_turns.get(user_key):
+            turns = pending_summary_turns.pop(user_key)
+            transcript = "\n".join(
+                f"{'Beck' if t['from'] == 'bot' else 'User'}: {t['text']}" for t in turns
+            )
+            try:
+                summary = await chat_completion([
+                    {"role": "system", "content": SUMMARY_PROMPT},
+                    {"role": "user", "content": (
+                        f"Current notes: {user_data.get('summary') or '(none)'}\n\n"
+                        f"New messages:\n{transcript}"
+                    )}
+                ], max_tokens=SUMMARY_MAX_TOKENS, temperature=0.3)
+            except Exception as e:
+                logger.error(f"Summary update error for {user_key}: {e}")
+                metrics.error("summary")
+                # Keep the turns so the next eviction retries them
+                pending_summary_turns.setdefault(user_key, [])[:0] = turns
+                return
+            user_data["summary"] = summary.strip()
+            user_data["summary_until"] = turns[-1]["timestamp"]
+            save_user_data(user_data)
+    finally:
+        user_cache.unpin(user_key)
+        summary_tasks.pop(user_key, None)
+
+# ===== ADMISSION =====
+# Bounded, prioritised admission in front of the model. At most
+# LLM_MAX_CONCURRENCY replies are generated at once; the rest wait in a heap
+# ordered by (priority, how many turns that user already has queued or in
+# progress across all their chats, arrival), so private chats and replies
+# to the bot go before group @mentions and one user busy in several chats
+# cannot starve the others. When the queue
+# is full, or a turn has waited ADMISSION_MAX_WAIT, the turn is shed and
+# answered with SHED_REPLY instead of timing out.
+PRIORITY_DIRECT = 0   # private chats and replies to the bot
+PRIORITY_MENTION = 1  # @mentions in groups
+SHED_REPLY = "So many people are talking to me right now 😅 give me a minute?"
+
+class AdmissionQueue:
+    def __init__(self):
+        self.slots = LLM_MAX_CONCURRENCY
+        self.max_depth = ADMISSION_MAX_QUEUE
+        self.max_wait = ADMISSION_MAX_WAIT
+        self.active = 0
+        self.waiting = []  # heap of [priority, user load, seq, user_id, future]
+        self.user_load = {}
+        self.seq = 0
+
+    def depth(self) -> int:
+        return len(self.waiting)
+
+    async def acquire(self, user_id: int, priority: int) -> bool:
+        # True once a slot is granted, False if the turn was shed
+        if self.active < self.slots and not self.waiting:
+            self.active += 1
+            self.user_load[user_id] = self.user_load.get(user_id, 0) + 1
+            return True
+
+        self.seq += 1
+        entry = [priority, self.user_load.get(user_id, 0), self.seq, user_id,
+                 asyncio.get_running_loop().create_future()]
+        if len(self.waiting) >= self.max_depth:
+            worst = max(self.waiting)
+            if entry[:3] > worst[:3]:
+                self.shed("depth")
+                return False
+            # The newcomer outranks the worst waiter, which is shed instead
+            self.remove(worst)
+            worst[4].set_result(False)
+            self.shed("depth")
+
+        heapq.heappush(self.waiting, entry)
+        self.user_load[user_id] = self.user_load.get(user_id, 0) + 1
+        future = entry[4]
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+        except asyncio.TimeoutError:
+            if future.done():
+                return future.result()
+            self.remove(entry)
+            self.shed("wait")
+            return False
+        except asyncio.CancelledError:
+            if future.done():
+                if future.result():
+                    self.release(user_id)
+            else:
+                self.remove(entry)
+            raise
+
+    def remove(self, entry: list):
+        self.waiting.remove(entry)
+        heapq.heapify(self.waiting)
+        self.drop_load(entry[3])
+
+    def release(self, user_id: int):
+        self.active -= 1
+        self.drop_load(user_id)
+        while self.active < self.slots and self.waiting:
+            entry = heapq.heappop(self.waiting)
+            self.active += 1
+            entry[4].set_result(True)
+
+    def drop_load(self, user_id: int):
+        load = self.user_load[user_id] - 1
+        if load:
+            self.user_load[user_id] = load
+        else:
+            del self.user_load[user_id]
+
+    def shed(self, reason: str):
+        metrics.inc("admission_shed_total", reason=reason)
+
+admission = AdmissionQueue()
+
+# ===== AI FUNCTIONS =====
+FALLBACK_REPLY = "Hmm, my mind went blank for a second... what were we saying?"
+
+async def get_ai_response(user_data: dict, user_message: str) -> str:
+    try:
+        return await chat_completion(prepare_history(user_data, user_message))
+    except Exception as e:
+        logger.error(f"AI API error: {e}")
+        metrics.error("model")
+        return FALLBACK_REPLY
+
+async def stream_ai_response(user_data: dict, user_message: str):
+    # Yields whole sentences as soon as the model has finished each one
+    splitter = SentenceSplitter()
+    sent_any = False
+    try:
+        async for delta in stream_chat_completion(prepare_history(user_data, user_message)):
+            for sentence in splitter.feed(delta):
+                sent_any = True
+                yield sentence
     except Exception as e:
         logger.error(f"AI API error: {e}")
-        return "Hmm, my mind went blank for a second... what were we saying?"
+        metrics.error("model")
+        if not sent_any:
+            yield FALLBACK_REPLY
+        return
+    tail = splitter.flush()
+    if tail:
+        yield tail
+    elif not sent_any:
+        yield FALLBACK_REPLY
 
 # ===== UTILITIES =====
-def clean_text(text: str, entities, bot_username: str) -> str:
-    if entities:
-        for ent in sorted(entities, key=lambda e: e.offset, reverse=True):
-            if ent.type == MessageEntity.MENTION and text[ent.offset:ent.offset+ent.length].lower() == f"@{bot_username}":
-                text = text[:ent.offset] + text[ent.offset+ent.length:]
+def extract_entities(text: str, entities, bot_username: str) -> tuple:
+    # One pass over the message entities. Returns the values per profile
+    # field and the (offset, length) spans that @mention the bot.
+    found = {}
+    bot_mentions = []
+    bot_mention = f"@{bot_username}"
+    for ent in entities or ():
+        field = ENTITY_FIELDS.get(ent.type)
+        if field is None:
+            continue
+        value = text[ent.offset:ent.offset+ent.length]
+        if field == "hashtags":
+            value = value.lower().strip("#")
+        elif field == "mentions":
+            value = value.lower()
+            if value == bot_mention:
+                bot_mentions.append((ent.offset, ent.length))
+            value = value.strip("@")
+        found.setdefault(field, []).append(value)
+    return found, bot_mentions
+
+def clean_text(text: str, bot_mentions: list) -> str:
+    for offset, length in sorted(bot_mentions, reverse=True):
+        text = text[:offset] + text[offset+length:]
     return text.strip()
 
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+
 def split_response(text: str):
-    return re.split(r'(?<=[.!?])\s+', text)
+    return SENTENCE_END.split(text)
+
+class SentenceSplitter:
+    # Incremental split_response: a sentence is only emitted once the
+    # whitespace after its terminator has arrived, so "3.5" or "..." mid-stream
+    # is never cut early.
+    def __init__(self):
+        self.buffer = ""
+
+    def feed(self, delta: str) -> list:
+        self.buffer += delta
+        parts = SENTENCE_END.split(self.buffer)
+        self.buffer = parts.pop()
+        return [p.strip() for p in parts if p.strip()]
+
+    def flush(self) -> str:
+        tail, self.buffer = self.buffer.strip(), ""
+        return tail
+
+# ===== OUTBOUND MESSAGES =====
+# Replies are queued per chat and sent by one sender task per chat, so
+# handlers return immediately. Token buckets keep us under Telegram's limits
+# (global, per chat and stricter for groups), consecutive messages to a chat
+# are spaced by TYPING_DELAY, and a RetryAfter pauses every sender.
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        # Takes a token now and returns how long to wait before using it;
+        # tokens may go negative, which queues later callers behind earlier ones
+        self.refill()
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+class OutboundScheduler:
+    def __init__(self):
+        self.global_bucket = TokenBucket(SEND_GLOBAL_RATE, 1)
+        self.chat_buckets = {}
+        self.queues = {}
+        self.tasks = {}
+        self.last_sent = {}
+        self.paused_until = 0.0
+
+    def enqueue(self, bot, chat_id: int, chat_type: str, text: str,
+                reply_to_message_id: int = None, received_at: float = None):
+        # received_at (perf_counter of the incoming message) is passed with the
+        # first chunk of a reply to measure end-to-end reply latency
+        queue = self.queues.get(chat_id)
+        if queue is None:
+            queue = self.queues[chat_id] = deque()
+        queue.append((bot, chat_type, text, reply_to_message_id, received_at, time.perf_counter()))
+        if chat_id not in self.tasks:
+            self.tasks[chat_id] = asyncio.create_task(self.chat_sender(chat_id))
+
+    def pending(self) -> int:
+        return sum(len(q) for q in self.queues.values())
+
+    def chat_bucket(self, chat_id: int, chat_type: str) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            rate = SEND_GROUP_RATE if chat_type in ("group", "supergroup") else SEND_CHAT_RATE
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate, SEND_BURST)
+        return bucket
+
+    async def wait_turn(self, chat_id: int, chat_type: str):
+        typing = self.last_sent.get(chat_id, 0.0) + TYPING_DELAY - time.monotonic()
+        await asyncio.sleep(max(typing, self.chat_bucket(chat_id, chat_type).reserve()))
+        while self.paused_until > time.monotonic():
+            await asyncio.sleep(self.paused_until - time.monotonic())
+        await asyncio.sleep(self.global_bucket.reserve())
+
+    async def chat_sender(self, chat_id: int):
+        from telegram.error import NetworkError, RetryAfter
+        queue = self.queues[chat_id]
+        try:
+            while queue:
+                bot, chat_type, text, reply_to_message_id, received_at, enqueued_at = queue[0]
+                for attempt in range(SEND_MAX_RETRIES + 1):
+                    await self.wait_turn(chat_id, chat_type)
+                    try:
+                        send_start = time.perf_counter()
+                        await bot.send_message(
+                            chat_id=chat_id,
+                            text=text,
+                            reply_to_message_id=reply_to_message_id,
+                            allow_sending_without_reply=True
+                        )
+                        sent_at = time.perf_counter()
+                        metrics.inc("messages_sent_total")
+                        metrics.observe("stage_seconds", sent_at - send_start, stage="send")
+                        metrics.observe("stage_seconds", send_start - enqueued_at, stage="send_wait")
+                        if received_at is not None:
+                            metrics.observe("reply_seconds", sent_at - received_at)
+                        break
+                    except RetryAfter as e:
+                        retry_after = e.retry_after
+                        if hasattr(retry_after, "total_seconds"):
+                            retry_after = retry_after.total_seconds()
+                        logger.warning(f"Flood control hit sending to {chat_id}, pausing {retry_after}s")
+                        metrics.inc("flood_waits_total")
+                        self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+                    except NetworkError as e:
+                        logger.warning(f"Network error sending to {chat_id}: {e}")
+                        metrics.error("send_retry")
+                        await asyncio.sleep(2 ** attempt)
+                    except Exception as e:
+                        logger.error(f"Error sending to {chat_id}: {e}")
+                        metrics.error("send")
+                        break
+                else:
+                    logger.error(f"Giving up on a message to {chat_id} after {SEND_MAX_RETRIES} retries")
+                    metrics.error("send")
+                self.last_sent[chat_id] = time.monotonic()
+                queue.popleft()
+        finally:
+            del self.tasks[chat_id]
+            if not queue:
+                del self.queues[chat_id]
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is not None:
+                idle = max(TYPING_DELAY, bucket.capacity / bucket.rate)
+                asyncio.get_running_loop().call_later(idle, self.forget, chat_id, idle)
+
+    def forget(self, chat_id: int, idle: float):
+        # Once a chat has been quiet long enough for its bucket to refill and
+        # its typing delay to pass, a fresh bucket behaves the same, so its
+        # state is dropped instead of kept for every chat ever seen. A chat
+        # that sent again meanwhile is left to its newer callback.
+        if chat_id in self.tasks or time.monotonic() - self.last_sent.get(chat_id, 0.0) < idle:
+            return
+        self.chat_buckets.pop(chat_id, None)
+        self.last_sent.pop(chat_id, None)
+
+    async def drain(self):
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks.values()), return_exceptions=True)
+
+outbound = OutboundScheduler()
+
+def send_reply(msg, text: str, received_at: float = None):
+    # Quote the message we answer in groups, like Message.reply_text does
+    reply_to = msg.message_id if msg.chat.type != "private" else None
+    outbound.enqueue(msg.get_bot(), msg.chat.id, msg.chat.type, text, reply_to, received_at)
+
+# ===== USAGE LIMITS =====
+# Per-user and per-chat token buckets on model calls, plus daily token
+# budgets charged from the usage block of each model response. Counters are
+# kept in memory and saved to USAGE_FILE by the flush loop; admins can read
+# them with /limits and override the defaults with /setlimit. Turns over a
+# limit get a canned reply instead of a model call, at most once per
+# LIMIT_NOTICE_INTERVAL per user and chat; later ones are dropped quietly.
+# In multi-process mode each worker counts only the conversations routed to
+# it: a user's limits hold, but a group whose members land on N workers can
+# get up to N times the chat limits.
+RATE_LIMIT_REPLY = "Slow down a little 😅 I can't keep up with you! Talk in a minute?"
+BUDGET_REPLY = "I'm all talked out for today 😴 let's pick this up tomorrow?"
+LIMIT_NOTICE_INTERVAL = 60
+
+# The model call that is running on behalf of (chat_id, user_id), if any
+usage_owner = contextvars.ContextVar("usage_owner", default=None)
+
+class UsageLimits:
+    def __init__(self):
+        self.day = date.today().isoformat()
+        self.tokens = {"users": {}, "chats": {}}
+        self.overrides = {"users": {}, "chats": {}}
+        self.buckets = {"users": {}, "chats": {}}
+        self.max_buckets = {"users": 10000, "chats": 10000}
+        self.notified = {}
+        self.dirty = False
+
+    def defaults(self, scope: str) -> dict:
+        if scope == "users":
+            return {"per_minute": USER_RATE_PER_MIN, "daily_tokens": USER_DAILY_TOKENS}
+        return {"per_minute": CHAT_RATE_PER_MIN, "daily_tokens": CHAT_DAILY_TOKENS}
+
+    def limits(self, scope: str, key: int) -> dict:
+        return {**self.defaults(scope), **self.overrides[scope].get(key, {})}
+
+    def bucket(self, scope: str, key: int) -> TokenBucket:
+        per_minute = self.limits(scope, key)["per_minute"]
+        bucket = self.buckets[scope].get(key)
+        if bucket is None or bucket.rate != per_minute / 60:
+            if len(self.buckets[scope]) >= self.max_buckets[scope]:
+                self.prune_buckets(scope)
+            bucket = self.buckets[scope][key] = TokenBucket(per_minute / 60, max(1.0, per_minute / 2))
+        return bucket
+
+    def prune_buckets(self, scope: str):
+        # A full bucket is no different from a new one, so only those still
+        # refilling are kept; the cap doubles if most of them are
+        buckets = self.buckets[scope]
+        for bucket in buckets.values():
+            bucket.refill()
+        self.buckets[scope] = {key: b for key, b in buckets.items() if b.tokens < b.capacity}
+        self.max_buckets[scope] = max(10000, 2 * len(self.buckets[scope]))
+
+    def roll_day(self):
+        today = date.today().isoformat()
+        if today != self.day:
+            self.day = today
+            self.tokens = {"users": {}, "chats": {}}
+            self.dirty = True
+
+    def check(self, chat_id: int, user_id: int):
+        # Returns None if a model call is allowed, otherwise "daily" or "rate".
+        # A zero limit means unlimited.
+        self.roll_day()
+        scopes = (("users", user_id), ("chats", chat_id))
+        for scope, key in scopes:
+            budget = self.limits(scope, key)["daily_tokens"]
+            if budget and self.tokens[scope].get(key, 0) >= budget:
+                return "daily"
+        buckets = [self.bucket(scope, key) for scope, key in scopes if self.limits(scope, key)["per_minute"]]
+        for bucket in buckets:
+            bucket.refill()
+        if any(bucket.tokens < 1 for bucket in buckets):
+            return "rate"
+        for bucket in buckets:
+            bucket.tokens -= 1
+        return None
+
+    def should_notify(self, chat_id: int, user_id: int) -> bool:
+        now = time.monotonic()
+        key = (chat_id, user_id)
+        if now - self.notified.get(key, -LIMIT_NOTICE_INTERVAL) < LIMIT_NOTICE_INTERVAL:
+            return False
+        self.notified[key] = now
+        if len(self.notified) > 10000:
+            self.notified = {k: t for k, t in self.notified.items() if now - t < LIMIT_NOTICE_INTERVAL}
+        return True
+
+    def charge(self, chat_id: int, user_id: int, tokens: int):
+        self.roll_day()
+        for scope, key in (("users", user_id), ("chats", chat_id)):
+            self.tokens[scope][key] = self.tokens[scope].get(key, 0) + tokens
+        self.dirty = True
+
+    def set_limit(self, scope: str, key: int, name: str, value):
+        # value None restores the default
+        override = self.overrides[scope].setdefault(key, {})
+        if value is None:
+            override.pop(name, None)
+        else:
+            override[name] = value
+        if not override:
+            del self.overrides[scope][key]
+        self.dirty = True
+
+    def reset(self, scope: str, key: int):
+        self.tokens[scope].pop(key, None)
+        self.buckets[scope].pop(key, None)
+        self.dirty = True
+
+    def describe(self, scope: str, key: int) -> str:
+        self.roll_day()
+        limits = self.limits(scope, key)
+        used = self.tokens[scope].get(key, 0)
+        budget = limits["daily_tokens"] or "unlimited"
+        rate = f"{limits['per_minute']:g}" if limits["per_minute"] else "unlimited"
+        custom = " (custom)" if key in self.overrides[scope] else ""
+        return f"{scope[:-1]} {key}{custom}: {used}/{budget} tokens today, {rate} replies/min"
+
+    def load(self, path: str = None):
+        # Adds to the counters already loaded, so the front can sum the workers' files
+        try:
+            with open(path or USAGE_FILE, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        for scope in ("users", "chats"):
+            self.overrides[scope].update({int(k): v for k, v in data.get("overrides", {}).get(scope, {}).items()})
+            if data.get("day") == self.day:
+                for k, v in data.get("tokens", {}).get(scope, {}).items():
+                    self.tokens[scope][int(k)] = self.tokens[scope].get(int(k), 0) + v
+
+    def snapshot(self):
+        # Serialized on the event loop; the caller writes it wherever it likes
+        if not self.dirty:
+            return None
+        self.dirty = False
+        return json.dumps({"day": self.day, "tokens": self.tokens, "overrides": self.overrides})
+
+def save_usage(snapshot: str):
+    try:
+        write_file_atomic(USAGE_FILE, snapshot)
+    except Exception as e:
+        logger.error(f"Failed to save usage counters: {e}")
+        metrics.error("save")
+        usage_limits.dirty = True
+
+def usage_file(worker: int = None) -> str:
+    name = "usage.json" if worker is None else f"usage-{worker}.json"
+    return os.path.join(DATA_DIR, "limits", name)
+
+def read_usage_limits(paths: list) -> UsageLimits:
+    limits = UsageLimits()
+    for path in paths:
+        limits.load(path)
+    return limits
+
+def parse_limit_command(args: list):
+    # /setlimit arguments as (scope, key, name, value), name "reset" for a
+    # reset; None if they don't parse
+    if len(args) < 3 or args[0] not in ("user", "chat"):
+        return None
+    scope = args[0] + "s"
+    try:
+        key = int(args[1])
+    except ValueError:
+        return None
+    if args[2] == "reset" and len(args) == 3:
+        return scope, key, "reset", None
+    if args[2] not in ("per_minute", "daily_tokens") or len(args) != 4:
+        return None
+    if args[3] == "default":
+        return scope, key, args[2], None
+    try:
+        value = float(args[3]) if args[2] == "per_minute" else int(args[3])
+    except ValueError:
+        return None
+    return scope, key, args[2], value
+
+def apply_limit_command(limits: UsageLimits, scope: str, key: int, name: str, value):
+    if name == "reset":
+        limits.reset(scope, key)
+    else:
+        limits.set_limit(scope, key, name, value)
+
+usage_limits = UsageLimits()
+
+# ===== PROFILE PHOTOS =====
+# Looked up in a background task, at most one per conversation at a time.
+# "Checked, none found" is remembered in profile_photo_checked so users
+# without a photo are only asked about again after PHOTO_RECHECK_TTL.
+photo_lookups = {}
+
+def needs_photo_lookup(user_data: dict) -> bool:
+    if user_data["profile_photo"]:
+        return False
+    checked = user_data.get("profile_photo_checked")
+    if not checked:
+        return True
+    try:
+        age = datetime.now() - datetime.fromisoformat(checked)
+    except ValueError:
+        return True
+    return age.total_seconds() > PHOTO_RECHECK_TTL
+
+def schedule_photo_lookup(bot, chat_id: int, user_id: int):
+    user_key = make_user_key(chat_id, user_id)
+    if user_key not in photo_lookups:
+        photo_lookups[user_key] = asyncio.create_task(resolve_profile_photo(bot, chat_id, user_id))
+
+async def resolve_profile_photo(bot, chat_id: int, user_id: int):
+    file_id = None
+    try:
+        with metrics.timer("photo"):
+            photos = await bot.get_user_profile_photos(user_id, limit=1)
+        if photos.total_count > 0:
+            file_id = photos.photos[0][-1].file_id
+    except Exception as e:
+        logger.error(f"Profile photo error: {e}")
+        metrics.error("photo")
+    finally:
+        del photo_lookups[make_user_key(chat_id, user_id)]
+
+    user_data = load_user_data(chat_id, user_id)
+    if file_id:
+        user_data["profile_photo"] = file_id
+    user_data["profile_photo_checked"] = datetime.now().isoformat()
+    save_user_data(user_data)
 
 # ===== COMMAND HANDLERS =====
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -214,10 +1972,7 @@ async def ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not target:
         return await update.message.reply_text("Provide a user ID or reply to their message.")
     
-    bl = load_blacklist()
-    if target not in bl:
-        bl.append(target)
-        save_blacklist(bl)
+    if blacklist.add(target):
         await update.message.reply_text(f"User {target} blacklisted.")
     else:
         await update.message.reply_text(f"User {target} already blacklisted.")
@@ -230,20 +1985,141 @@ async def unban_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         return await update.message.reply_text("Provide a user ID to unban.")
     
     target = int(context.args[0])
-    bl = load_blacklist()
     
-    if target in bl:
-        bl.remove(target)
-        save_blacklist(bl)
+    if blacklist.remove(target):
         await update.message.reply_text(f"User {target} removed from blacklist.")
     else:
         await update.message.reply_text(f"User {target} not found in blacklist.")
 
+async def show_limits(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        return await update.message.reply_text("You don't have permission to do that.")
+
+    router = context.application.bot_data.get("router")
+    if router:
+        # The front holds no counters; sum the workers' saved ones instead
+        limits = await asyncio.get_running_loop().run_in_executor(None, read_usage_limits, router.usage_files())
+    else:
+        limits = usage_limits
+
+    lines = []
+    if update.message.reply_to_message:
+        lines.append(limits.describe("users", update.message.reply_to_message.from_user.id))
+        lines.append(limits.describe("chats", update.effective_chat.id))
+    elif context.args:
+        try:
+            lines.append(limits.describe("users", int(context.args[0])))
+            if len(context.args) > 1:
+                lines.append(limits.describe("chats", int(context.args[1])))
+        except ValueError:
+            return await update.message.reply_text("Usage: /limits <user_id> [chat_id]")
+    else:
+        defaults = limits.defaults("users"), limits.defaults("chats")
+        lines.append(f"Defaults per user: {defaults[0]['per_minute']:g} replies/min, "
+                     f"{defaults[0]['daily_tokens']} tokens/day")
+        lines.append(f"Defaults per chat: {defaults[1]['per_minute']:g} replies/min, "
+                     f"{defaults[1]['daily_tokens']} tokens/day")
+        for scope in ("users", "chats"):
+            for key in sorted(limits.overrides[scope]):
+                lines.append(limits.describe(scope, key))
+    await update.message.reply_text("\n".join(lines))
+
+async def set_limit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        return await update.message.reply_text("You don't have permission to do that.")
+
+    usage = ("Usage: /setlimit <user|chat> <id> <per_minute|daily_tokens> <value|default>\n"
+             "       /setlimit <user|chat> <id> reset")
+    command = parse_limit_command(context.args or [])
+    if command is None:
+        return await update.message.reply_text(usage)
+
+    router = context.application.bot_data.get("router")
+    if router:
+        # Every worker enforces limits for its own conversations, so all of
+        # them get the change; the reply shows their saved counters with it
+        router.broadcast(("setlimit", *command))
+        limits = await asyncio.get_running_loop().run_in_executor(None, read_usage_limits, router.usage_files())
+    else:
+        limits = usage_limits
+    apply_limit_command(limits, *command)
+    await update.message.reply_text(limits.describe(*command[:2]))
+
+async def who_used(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        return await update.message.reply_text("You don't have permission to do that.")
+
+    router = context.application.bot_data.get("router")
+    if router:
+        # The front holds no records; read the workers' journals instead
+        paths = entity_index_files(len(router.queues))
+        index = await asyncio.get_running_loop().run_in_executor(None, read_entity_index, paths)
+    else:
+        index = entity_index
+
+    if not context.args:
+        lines = ["Top hashtags:"]
+        lines += [f"#{value}: {count} users" for count, value in index.top("hashtags", 10)]
+        lines.append("Top mentions:")
+        lines += [f"@{value}: {count} users" for count, value in index.top("mentions", 10)]
+        lines.append("Usage: /who <#hashtag|@mention>")
+        return await update.message.reply_text("\n".join(lines))
+
+    term = context.args[0].lower()
+    kind = "mentions" if term.startswith("@") else "hashtags"
+    value = term.lstrip("#@")
+    keys = index.lookup(kind, value)
+    shown = keys[:50]
+    text = f"{len(keys)} users used {'@' if kind == 'mentions' else '#'}{value}"
+    if shown:
+        text += ":\n" + "\n".join(shown)
+    if len(keys) > len(shown):
+        text += f"\n... and {len(keys) - len(shown)} more"
+    await update.message.reply_text(text)
+
+def format_stats() -> str:
+    lines = ["Stage latency (count, avg, p95):"]
+    for (name, labels), histogram in sorted(metrics.histograms.items()):
+        if not histogram.count:
+            continue
+        label = dict(labels).get("stage", name)
+        lines.append(
+            f"  {label}: {histogram.count}, {histogram.sum / histogram.count * 1000:.1f}ms, "
+            f"<={histogram.quantile(0.95) * 1000:g}ms"
+        )
+    lines.append("Counters:")
+    for (name, labels), value in sorted(metrics.counters.items()):
+        lines.append(f"  {name}{format_labels(labels)}: {value:g}")
+    lookups = user_cache.hits + user_cache.misses
+    hit_rate = user_cache.hits / lookups * 100 if lookups else 0.0
+    lines.append(f"User cache: {len(user_cache.records)} records, {hit_rate:.1f}% hits")
+    lines.append(
+        f"Queues: {metrics.gauges['conversation_queue_depth']():g} waiting turns, "
+        f"{outbound.pending()} outgoing messages, {len(summary_tasks)} summaries"
+    )
+    return "\n".join(lines)
+
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        return await update.message.reply_text("You don't have permission to do that.")
+    
+    router = context.application.bot_data.get("router")
+    if router:
+        # Each worker keeps its own metrics; the front only knows what it routed
+        lines = [f"{len(router.queues)} workers, updates routed: " + ", ".join(map(str, router.routed))]
+        if METRICS_PORT:
+            lines.append(f"Worker metrics: http://127.0.0.1:{METRICS_PORT + 1}/metrics "
+                         f"through port {METRICS_PORT + len(router.queues)}")
+        else:
+            lines.append("Set METRICS_PORT to read each worker's metrics.")
+        return await update.message.reply_text("\n".join(lines))
+    await update.message.reply_text(format_stats())
+
 async def list_banned(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_user.id not in ADMIN_IDS:
         return await update.message.reply_text("You don't have permission to do that.")
     
-    bl = load_blacklist()
+    bl = sorted(blacklist.ids)
     text = "Blacklisted users:\n" + "\n".join(str(x) for x in bl) if bl else "Blacklist is empty."
     await update.message.reply_text(text)
 
@@ -259,6 +2135,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if is_blacklisted(user.id):
         return
 
+    received_at = time.perf_counter()
+    metrics.inc("updates_total", chat_type=chat.type)
+
     # Load and update user data
     user_data = load_user_data(chat.id, user.id)
     user_data.update({
@@ -271,95 +2150,509 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         "chat_type": chat.type
     })
 
-    # Profile photo handling
-    if not user_data["profile_photo"]:
-        try:
-            photos = await context.bot.get_user_profile_photos(user.id, limit=1)
-            if photos.total_count > 0:
-                user_data["profile_photo"] = photos.photos[0][-1].file_id
-        except Exception as e:
-            logger.error(f"Profile photo error: {e}")
+    # Profile photo handling, resolved in the background
+    if needs_photo_lookup(user_data):
+        schedule_photo_lookup(context.bot, chat.id, user.id)
 
-    # Entity parsing
+    # Entity parsing, which also finds the @mentions of the bot
+    bot_mentions = []
     if msg.entities:
+        entities_start = time.perf_counter()
         user_data["entities_parsed"] += len(msg.entities)
-        for ent in msg.entities:
-            try:
-                entity_text = msg.text[ent.offset:ent.offset+ent.length]
-                if ent.type == MessageEntity.URL:
-                    if entity_text not in user_data["links"]:
-                        user_data["links"].append(entity_text)
-                elif ent.type == MessageEntity.PHONE_NUMBER:
-                    if entity_text not in user_data["phone_numbers"]:
-                        user_data["phone_numbers"].append(entity_text)
-                elif ent.type == MessageEntity.HASHTAG:
-                    clean_hashtag = entity_text.lower().strip("#")
-                    if clean_hashtag not in user_data["hashtags"]:
-                        user_data["hashtags"].append(clean_hashtag)
-                elif ent.type == MessageEntity.MENTION:
-                    clean_mention = entity_text.lower().strip("@")
-                    if clean_mention not in user_data["mentions"]:
-                        user_data["mentions"].append(clean_mention)
-            except Exception as e:
-                logger.error(f"Entity parsing error: {e}")
+        try:
+            found, bot_mentions = extract_entities(msg.text, msg.entities, (context.bot.username or "").lower())
+            add_entities(user_data, found)
+        except Exception as e:
+            logger.error(f"Entity parsing error: {e}")
+            metrics.error("entities")
+        metrics.observe("stage_seconds", time.perf_counter() - entities_start, stage="entities")
 
     # Save data before processing response
     save_user_data(user_data)
 
     # Check if message is for the bot
-    bot_username = (context.bot.username or "").lower()
-    mentioned = any(
-        ent.type == MessageEntity.MENTION and msg.text[ent.offset:ent.offset+ent.length].lower() == f"@{bot_username}"
-        for ent in (msg.entities or [])
-    )
+    mentioned = bool(bot_mentions)
     is_reply = msg.reply_to_message and msg.reply_to_message.from_user.id == context.bot.id
     is_private = msg.chat.type == 'private'
 
     if not (is_private or mentioned or is_reply):
+        metrics.observe("stage_seconds", time.perf_counter() - received_at, stage="handler")
         return
 
     # Process message
-    text = clean_text(msg.text, msg.entities, bot_username)
-    user_data['messages'].append({
-        "from": "user",
-        "text": text,
-        "timestamp": datetime.now().isoformat()
-    })
+    text = clean_text(msg.text, bot_mentions)
+    priority = PRIORITY_DIRECT if is_private or is_reply else PRIORITY_MENTION
+    enqueue_turn(make_user_key(chat.id, user.id), msg, text, received_at, priority)
+    metrics.observe("stage_seconds", time.perf_counter() - received_at, stage="handler")
+
+async def reply_to_burst(messages: list, texts: list, received_at: float = None,
+                         priority: int = PRIORITY_DIRECT) -> None:
+    msg = messages[-1]
+    text = "\n".join(texts)
+
+    limited = usage_limits.check(msg.chat.id, msg.from_user.id)
+    if limited:
+        metrics.inc("limited_total", reason=limited)
+        if usage_limits.should_notify(msg.chat.id, msg.from_user.id):
+            send_reply(msg, BUDGET_REPLY if limited == "daily" else RATE_LIMIT_REPLY, received_at)
+        user_data = load_user_data(msg.chat.id, msg.from_user.id)
+        append_message(user_data, "user", text)
+        save_user_data(user_data)
+        return
+
+    with metrics.timer("admission"):
+        admitted = await admission.acquire(msg.from_user.id, priority)
+    user_data = load_user_data(msg.chat.id, msg.from_user.id)
+    if not admitted:
+        send_reply(msg, SHED_REPLY, received_at)
+        append_message(user_data, "user", text)
+        save_user_data(user_data)
+        return
+    owner = usage_owner.set((msg.chat.id, msg.from_user.id))
+    user_key = make_user_key(msg.chat.id, msg.from_user.id)
+    user_cache.pin(user_key, user_data)
 
     # Generate and send response
+    sentences = []
     try:
-        ai_reply = get_ai_response(user_data, text)
-        user_data['messages'].append({
-            "from": "bot",
-            "text": ai_reply,
-            "timestamp": datetime.now().isoformat()
-        })
-        
-        for chunk in split_response(ai_reply):
-            if chunk.strip():
-                await msg.reply_text(chunk.strip())
-                await asyncio.sleep(0.5)
+        if STREAM_REPLIES:
+            async for sentence in stream_ai_response(user_data, text):
+                send_reply(msg, sentence, None if sentences else received_at)
+                sentences.append(sentence)
+        else:
+            ai_reply = await get_ai_response(user_data, text)
+            sentences = [chunk.strip() for chunk in split_response(ai_reply) if chunk.strip()]
+            for i, chunk in enumerate(sentences):
+                send_reply(msg, chunk, None if i else received_at)
                 
     except Exception as e:
         logger.error(f"Response generation error: {e}")
-        await msg.reply_text("Hmm, I'm having trouble thinking straight right now...")
+        metrics.error("reply")
+        send_reply(msg, "Hmm, I'm having trouble thinking straight right now...")
+    finally:
+        admission.release(msg.from_user.id)
+        usage_owner.reset(owner)
+        user_cache.unpin(user_key)
+
+    # The prompt was built from the earlier turns, so the new user turn is
+    # recorded only now; whatever the model produced follows as a single turn
+    append_message(user_data, "user", text)
+    if sentences:
+        append_message(user_data, "bot", " ".join(sentences))
     
     # Final save with updated messages
     save_user_data(user_data)
 
+# ===== CONVERSATION QUEUES =====
+# Every conversation (chat + user) gets one worker task that answers its
+# messages in order. Messages arriving within BURST_WINDOW of the first one
+# are merged into a single user turn and a single model call.
+conversation_queues = {}
+conversation_tasks = {}
+conversations_busy = set()
+
+def enqueue_turn(user_key: str, msg, text: str, received_at: float = None,
+                 priority: int = PRIORITY_DIRECT):
+    queue = conversation_queues.get(user_key)
+    if queue is None:
+        queue = conversation_queues[user_key] = asyncio.Queue()
+    queue.put_nowait((msg, text, received_at, priority))
+    if user_key not in conversation_tasks:
+        conversation_tasks[user_key] = asyncio.create_task(conversation_worker(user_key, queue))
+
+async def collect_burst(queue: asyncio.Queue, first: tuple) -> list:
+    burst = [first]
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + BURST_WINDOW
+    while True:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        try:
+            burst.append(await asyncio.wait_for(queue.get(), timeout=remaining))
+        except asyncio.TimeoutError:
+            break
+    while not queue.empty():
+        burst.append(queue.get_nowait())
+    return burst
+
+async def conversation_worker(user_key: str, queue: asyncio.Queue):
+    while True:
+        try:
+            first = await asyncio.wait_for(queue.get(), timeout=CONVERSATION_IDLE_TIMEOUT)
+        except asyncio.TimeoutError:
+            # Re-check: a message may have arrived just as the wait timed out
+            if queue.empty():
+                del conversation_tasks[user_key]
+                del conversation_queues[user_key]
+                return
+            continue
+        conversations_busy.add(user_key)
+        try:
+            burst = await collect_burst(queue, first)
+            metrics.inc("bursts_total")
+            metrics.inc("burst_messages_total", len(burst))
+            await reply_to_burst([m for m, _, _, _ in burst], [t for _, t, _, _ in burst], burst[0][2],
+                                 min(p for _, _, _, p in burst))
+        except Exception as e:
+            logger.error(f"Conversation error for {user_key}: {e}")
+            metrics.error("conversation")
+        finally:
+            conversations_busy.discard(user_key)
+
+async def drain_conversations(timeout: float):
+    # Lets queued and in-progress turns finish, then stops the idle workers
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while conversations_busy or any(not q.empty() for q in conversation_queues.values()):
+        if loop.time() > deadline:
+            logger.warning(f"Gave up waiting for {len(conversations_busy)} conversations to finish")
+            break
+        await asyncio.sleep(0.05)
+    pending = list(summary_tasks.values()) + list(photo_lookups.values())
+    if pending:
+        await asyncio.wait(pending, timeout=max(0.0, deadline - loop.time()))
+    for task in list(conversation_tasks.values()):
+        task.cancel()
+    await asyncio.gather(*conversation_tasks.values(), return_exceptions=True)
+    conversation_tasks.clear()
+    conversation_queues.clear()
+
+# ===== WEBHOOK =====
+# Optional replacement for long polling (BOT_MODE=webhook). Telegram POSTs
+# updates to WEBHOOK_PATH; each one is handed to the Application's update
+# queue and handled concurrently, at most MAX_INFLIGHT_UPDATES at a time.
+# If WEBHOOK_URL is empty the webhook is not registered with Telegram, which
+# is how the server is tested locally with recorded updates.
+async def serve_webhook(app: Application, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        method, path, headers, body = await read_http_request(reader)
+        if method != "POST" or path != WEBHOOK_PATH:
+            await write_http_response(writer, "404 Not Found", b"not found\n")
+        elif WEBHOOK_SECRET and headers.get("x-telegram-bot-api-secret-token") != WEBHOOK_SECRET:
+            await write_http_response(writer, "403 Forbidden", b"bad secret\n")
+        else:
+            from telegram import Update
+            update = Update.de_json(json.loads(body), app.bot)
+            await app.update_queue.put(update)
+            metrics.inc("webhook_updates_total")
+            await write_http_response(writer, "200 OK")
+    except Exception as e:
+        logger.error(f"Webhook error: {e}")
+        metrics.error("webhook")
+        try:
+            await write_http_response(writer, "400 Bad Request", b"bad update\n")
+        except Exception:
+            pass
+    finally:
+        writer.close()
+
+async def finish_updates(app: Application):
+    # app.stop() does not await handlers still running for queued updates
+    # when updates are processed concurrently, so wait for them first
+    try:
+        await asyncio.wait_for(app.update_queue.join(), DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"{app.update_queue.qsize()} updates still queued at shutdown")
+
+def check_webhook_config():
+    # Without the secret anyone who reaches the port can post updates that
+    # claim to come from an admin, so a public webhook refuses to start
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET must be set when WEBHOOK_URL is")
+
+async def run_webhook(app: Application, stop_event: asyncio.Event = None):
+    check_webhook_config()
+    if stop_event is None:
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop_event.set)
+
+    async with app:
+        await app.post_init(app)
+        if WEBHOOK_URL:
+            from telegram import Update
+            await app.bot.set_webhook(
+                WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=Update.ALL_TYPES
+            )
+        await app.start()
+        server = await asyncio.start_server(
+            lambda r, w: serve_webhook(app, r, w), WEBHOOK_LISTEN, WEBHOOK_PORT
+        )
+        logger.info(f"Webhook server listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+        await stop_event.wait()
+
+        # Graceful drain: refuse new updates, finish the queued ones, let
+        # on_stop finish in-flight replies, then on_shutdown flushes user data
+        logger.info("Stopping webhook server...")
+        server.close()
+        await server.wait_closed()
+        await finish_updates(app)
+        await app.stop()
+        await app.post_stop(app)
+    await app.post_shutdown(app)
+
+
+# ===== SHARDING =====
+# Multi-process mode (BOT_WORKERS > 0). The front process receives updates
+# (polling or webhook) and routes each one by a stable hash of its
+# conversation key to one of N worker processes, so a conversation always
+# lands on the same worker and that worker's user cache never goes stale.
+# The front owns the blacklist: it answers /ban, /unban and /blacklist
+# itself and drops updates from banned users before routing, so every
+# worker sees the same decision without cross-process locking. Admin
+# commands that read or change per-worker state are answered by the front
+# too: /setlimit is broadcast to every worker through its queue, /limits
+# and /who read the workers' files, and /stats points at their metrics.
+WORKER_START_TIMEOUT = 60
+
+def shard_for(chat_id: int, user_id: int, workers: int) -> int:
+    return shard_of_key(make_user_key(chat_id, user_id), workers)
+
+def shard_of_key(user_key: str, workers: int) -> int:
+    return zlib.crc32(user_key.encode("ascii")) % workers
+
+class ShardRouter:
+    def __init__(self, workers: int, app_factory=None):
+        methods = multiprocessing.get_all_start_methods()
+        ctx = multiprocessing.get_context("fork" if "fork" in methods else "spawn")
+        self.queues = [ctx.Queue() for _ in range(workers)]
+        self.ready = ctx.Queue()
+        self.processes = [
+            ctx.Process(target=run_worker, args=(i, workers, queue, app_factory, self.ready), name=f"beck-worker-{i}")
+            for i, queue in enumerate(self.queues)
+        ]
+        self.routed = [0] * workers
+
+    def start(self):
+        # Call before the front's event loop starts, so forked workers begin clean
+        for process in self.processes:
+            process.start()
+        deadline = time.monotonic() + WORKER_START_TIMEOUT
+        started = set()
+        while len(started) < len(self.processes):
+            try:
+                started.add(self.ready.get(timeout=1))
+                continue
+            except Empty:
+                pass
+            failed = [p for p in self.processes if p.exitcode is not None]
+            if failed or time.monotonic() > deadline:
+                for process in self.processes:
+                    if process.is_alive():
+                        process.terminate()
+                    process.join()
+                if failed:
+                    raise RuntimeError(f"{failed[0].name} exited with code {failed[0].exitcode} during startup")
+                raise RuntimeError(f"Workers not ready after {WORKER_START_TIMEOUT}s")
+        logger.info(f"Started {len(self.processes)} worker processes")
+
+    def dispatch(self, chat_id: int, user_id: int, data: dict):
+        shard = shard_for(chat_id, user_id, len(self.queues))
+        self.routed[shard] += 1
+        self.queues[shard].put(data)
+
+    def broadcast(self, command: tuple):
+        # Updates are dicts; tuples are commands for every worker
+        for queue in self.queues:
+            queue.put(command)
+
+    def usage_files(self) -> list:
+        return [usage_file(i) for i in range(len(self.queues))]
+
+    def stop(self):
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join(DRAIN_TIMEOUT + 10)
+            if process.is_alive():
+                logger.warning(f"{process.name} did not stop in time, terminating")
+                process.terminate()
+
+def run_worker(index: int, workers: int, queue, app_factory, ready):
+    global METRICS_PORT, USAGE_FILE, ENTITY_INDEX_FILE, SHARD, SEND_GLOBAL_RATE
+    if METRICS_PORT:
+        METRICS_PORT += index + 1
+    # Each worker sees only its own conversations, so it keeps its own counters
+    USAGE_FILE = usage_file(index)
+    ENTITY_INDEX_FILE = entity_index_file(index, workers)
+    SHARD = (index, workers)
+    # Every worker sends through its own scheduler, so they split the bot's
+    # overall rate. Per-chat rates stay as they are: a private chat is served
+    # by one worker, though a busy group's replies may come from several.
+    SEND_GLOBAL_RATE /= workers
+    outbound.global_bucket = TokenBucket(SEND_GLOBAL_RATE, 1)
+    # Ctrl+C goes to the whole process group; the front stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(worker_main(queue, app_factory or build_application, ready, index))
+
+async def worker_main(queue, app_factory, ready, index: int):
+    from telegram import Update
+    loop = asyncio.get_running_loop()
+    app = app_factory()
+    async with app:
+        await app.post_init(app)
+        await app.start()
+        ready.put(index)
+        running = True
+        while running:
+            batch = [await loop.run_in_executor(None, queue.get)]
+            while True:
+                try:
+                    batch.append(queue.get_nowait())
+                except Empty:
+                    break
+            for data in batch:
+                if data is None:
+                    running = False
+                    break
+                if isinstance(data, tuple):
+                    apply_limit_command(usage_limits, *data[1:])
+                    continue
+                await app.update_queue.put(Update.de_json(data, app.bot))
+        await finish_updates(app)
+        await app.stop()
+        await app.post_stop(app)
+    await app.post_shutdown(app)
+
+async def route_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    chat = update.effective_chat
+    if user and is_blacklisted(user.id):
+        return
+    chat_id = chat.id if chat else 0
+    user_id = user.id if user else 0
+    context.application.bot_data["router"].dispatch(chat_id, user_id, update.to_dict())
+    metrics.inc("updates_routed_total")
+
+async def on_front_startup(app: Application) -> None:
+    blacklist.refresh()
+    background_tasks.append(asyncio.create_task(blacklist_watch_loop()))
+    if METRICS_PORT:
+        metrics_servers.append(await asyncio.start_server(serve_metrics, "127.0.0.1", METRICS_PORT))
+
+async def on_front_stop(app: Application) -> None:
+    await asyncio.get_running_loop().run_in_executor(None, app.bot_data["router"].stop)
+
+def build_front_application(router: ShardRouter, builder=None) -> Application:
+    from telegram import Update
+    from telegram.ext import Application, CommandHandler, TypeHandler
+    if builder is None:
+        builder = Application.builder().token(TELEGRAM_TOKEN)
+    app = (
+        builder
+        .post_init(on_front_startup)
+        .post_stop(on_front_stop)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    app.bot_data["router"] = router
+
+    app.add_handler(CommandHandler('ban', ban_user))
+    app.add_handler(CommandHandler('unban', unban_user))
+    app.add_handler(CommandHandler('blacklist', list_banned))
+    app.add_handler(CommandHandler('who', who_used))
+    app.add_handler(CommandHandler('limits', show_limits))
+    app.add_handler(CommandHandler('setlimit', set_limit))
+    app.add_handler(CommandHandler('stats', show_stats))
+    app.add_handler(TypeHandler(Update, route_update))
+    return app
+
 # ===== MAIN =====
-if __name__ == '__main__':
-    ensure_data_dir()
-    if not os.path.exists(BLACKLIST_FILE):
-        save_blacklist([])
+background_tasks = []
+metrics_servers = []
+
+metrics.gauge("user_cache_records", lambda: len(user_cache.records))
+metrics.gauge("user_cache_dirty", lambda: len(user_cache.dirty) + len(user_cache.evicted))
+metrics.gauge("user_cache_hits_total", lambda: user_cache.hits)
+metrics.gauge("user_cache_misses_total", lambda: user_cache.misses)
+metrics.gauge("conversations_active", lambda: len(conversation_tasks))
+metrics.gauge("conversation_queue_depth", lambda: sum(q.qsize() for q in conversation_queues.values()))
+metrics.gauge("outbound_queue_depth", lambda: outbound.pending())
+metrics.gauge("admission_queue_depth", lambda: admission.depth())
+metrics.gauge("admission_in_service", lambda: admission.active)
+metrics.gauge("model_circuits_open", lambda: backend.open_circuits())
+metrics.gauge("summaries_in_progress", lambda: len(summary_tasks))
+metrics.gauge("photo_lookups_in_flight", lambda: len(photo_lookups))
+metrics.gauge("blacklist_size", lambda: len(blacklist.ids))
+metrics.gauge("entity_index_values", lambda: sum(len(users) for users in entity_index.users.values()))
+
+async def on_startup(app: Application) -> None:
+    blacklist.refresh()
+    usage_limits.load()
+    await asyncio.get_running_loop().run_in_executor(None, load_entity_index)
+    if WARMUP_USERS:
+        background_tasks.append(asyncio.create_task(warm_up_cache(min(WARMUP_USERS, USER_CACHE_SIZE))))
+    background_tasks.append(asyncio.create_task(flush_loop()))
+    background_tasks.append(asyncio.create_task(blacklist_watch_loop()))
+    if COMPACT_INTERVAL:
+        background_tasks.append(asyncio.create_task(compact_loop()))
+    if METRICS_PORT:
+        metrics_servers.append(await asyncio.start_server(serve_metrics, "127.0.0.1", METRICS_PORT))
+        logger.info(f"Metrics available at http://127.0.0.1:{METRICS_PORT}/metrics")
 
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
+async def on_stop(app: Application) -> None:
+    # Runs after the last update was handled but while the bot can still send
+    await drain_conversations(DRAIN_TIMEOUT)
+    await outbound.drain()
+
+async def on_shutdown(app: Application) -> None:
+    for server in metrics_servers:
+        server.close()
+    metrics_servers.clear()
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    flush_user_data()
+    await close_http_client()
+
+def build_application(builder=None) -> Application:
+    from telegram.ext import Application, CommandHandler, MessageHandler, filters
+    # The benchmarks pass a builder wired to a fake Bot API
+    if builder is None:
+        builder = Application.builder().token(TELEGRAM_TOKEN)
+    app = (
+        builder
+        .concurrent_updates(MAX_INFLIGHT_UPDATES)
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     app.add_handler(CommandHandler('start', start))
     app.add_handler(CommandHandler('ban', ban_user))
     app.add_handler(CommandHandler('unban', unban_user))
     app.add_handler(CommandHandler('blacklist', list_banned))
+    app.add_handler(CommandHandler('stats', show_stats))
+    app.add_handler(CommandHandler('limits', show_limits))
+    app.add_handler(CommandHandler('setlimit', set_limit))
+    app.add_handler(CommandHandler('who', who_used))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    return app
 
-    logger.info("Bot started...")
-    app.run_polling()
+if __name__ == '__main__':
+    ensure_data_dir()
+    if not os.path.exists(BLACKLIST_FILE):
+        save_blacklist([])
+    if BOT_MODE == "webhook":
+        check_webhook_config()
+
+    if BOT_WORKERS > 0:
+        router = ShardRouter(BOT_WORKERS)
+        router.start()
+        app = build_front_application(router)
+    else:
+        app = build_application()
+
+    if BOT_MODE == "webhook":
+        logger.info("Bot started in webhook mode...")
+        asyncio.run(run_webhook(app))
+    else:
+        logger.info("Bot started...")
+        app.run_polling()
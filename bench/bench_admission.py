@@ -0,0 +1,59 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import beck
+from bench_load import percentile
+
+# Fairness of the admission queue. One heavy user sends a turn in each of
+# many chats at once (every chat is its own conversation, so nothing
+# serialises them before admission), then light users each send one turn.
+# With slots kept busy, the light users' turns should be admitted ahead of
+# the heavy user's backlog, not behind it.
+
+async def turn(user_id: int, service: float, waits: dict):
+    start = time.perf_counter()
+    admitted = await beck.admission.acquire(user_id, beck.PRIORITY_DIRECT)
+    waits.setdefault(user_id, []).append(time.perf_counter() - start)
+    if admitted:
+        try:
+            await asyncio.sleep(service)
+        finally:
+            beck.admission.release(user_id)
+    return admitted
+
+async def main(args) -> dict:
+    beck.LLM_MAX_CONCURRENCY = args.slots
+    beck.ADMISSION_MAX_QUEUE = 100000
+    beck.ADMISSION_MAX_WAIT = 3600
+    beck.admission = beck.AdmissionQueue()
+    waits = {}
+    heavy = [asyncio.create_task(turn(0, args.service, waits)) for _ in range(args.heavy_chats)]
+    await asyncio.sleep(0)
+    light = [asyncio.create_task(turn(user_id, args.service, waits)) for user_id in range(1, args.light_users + 1)]
+    await asyncio.gather(*heavy, *light)
+    return waits
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-user fairness of the admission queue")
+    parser.add_argument("--slots", type=int, default=4, help="concurrent model calls")
+    parser.add_argument("--heavy-chats", type=int, default=40, help="chats the heavy user writes in at once")
+    parser.add_argument("--light-users", type=int, default=20)
+    parser.add_argument("--service", type=float, default=0.02, help="seconds per model call")
+    args = parser.parse_args()
+
+    waits = asyncio.run(main(args))
+    heavy = waits.pop(0)
+    light = [w for user_waits in waits.values() for w in user_waits]
+    print(f"{args.heavy_chats} turns from one user in separate chats, then {args.light_users} users "
+          f"with one turn each, {args.slots} slots")
+    print(f"  heavy user:  p50 wait {percentile(heavy, 0.5) * 1000:6.0f}ms  max {max(heavy) * 1000:6.0f}ms")
+    print(f"  light users: p50 wait {percentile(light, 0.5) * 1000:6.0f}ms  max {max(light) * 1000:6.0f}ms")
+    # Light users may wait for the slots already taken and one admission round, no more
+    bound = (args.light_users / args.slots + 2) * args.service
+    if max(light) > bound:
+        sys.exit(f"FAIL: light users waited up to {max(light) * 1000:.0f}ms behind the heavy user's backlog")
@@ -0,0 +1,130 @@
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import beck
+from bench_load import percentile
+from stub_model_server import DEFAULT_REPLY, start_stub_server
+
+# Runs the model backend against the fault-injecting stub server: transient
+# 503s, hanging requests, a dead primary model, a dead provider, a slow tail
+# with and without hedging, and streamed replies under errors. Each scenario
+# checks what the caller sees and reports latency and backend counters.
+
+FALLBACK_MODEL = "accounts/fireworks/models/stub-fallback"
+MESSAGES = [{"role": "user", "content": "hi there"}]
+
+def counter(name: str) -> float:
+    return sum(v for (n, _), v in beck.metrics.counters.items() if n == name)
+
+async def timed(call) -> tuple:
+    start = time.perf_counter()
+    try:
+        result = await call()
+    except Exception as e:
+        result = e
+    return result, time.perf_counter() - start
+
+async def run_calls(calls: int, concurrency: int, call) -> list:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            return await timed(call)
+    return await asyncio.gather(*(one() for _ in range(calls)))
+
+async def complete():
+    return await beck.chat_completion(MESSAGES)
+
+async def reply():
+    return await beck.get_ai_response({"messages": []}, "hi there")
+
+async def stream():
+    return "".join([delta async for delta in beck.stream_chat_completion(MESSAGES)])
+
+async def scenario(server, args, faults: dict, call, calls: int = None, warmup: int = 0, **config) -> list:
+    for name, value in config.items():
+        setattr(beck, name, value)
+    beck.backend = beck.ModelBackend()
+    beck.metrics = beck.Metrics()
+    server.set_faults()
+    # Warm the pooled client, and the hedging latency histogram if asked
+    await run_calls(max(1, warmup), args.concurrency, complete)
+    server.set_faults(**faults)
+    results = await run_calls(calls or args.calls, args.concurrency, call)
+    await beck.close_http_client()
+    return results
+
+def report(name: str, results: list, expected: str) -> bool:
+    latencies = [elapsed for _, elapsed in results]
+    good = sum(1 for result, _ in results if result == expected)
+    print(f"{name}")
+    print(f"  ok {good}/{len(results)}  p50 {percentile(latencies, 0.5) * 1000:.0f}ms  "
+          f"p99 {percentile(latencies, 0.99) * 1000:.0f}ms  retries {counter('model_retries_total'):g}  "
+          f"fallbacks {counter('model_fallbacks_total'):g}  fast fails {counter('model_fast_fail_total'):g}  "
+          f"hedges {counter('model_hedges_total'):g} (won {counter('model_hedge_wins_total'):g})")
+    return good == len(results)
+
+async def main(server, args) -> bool:
+    ok = True
+    base = dict(LLM_TIMEOUT=0.5, LLM_DEADLINE=5.0, LLM_RETRIES=3, LLM_RETRY_BACKOFF=0.05,
+                LLM_FALLBACK_MODELS=[FALLBACK_MODEL], BREAKER_THRESHOLD=10, BREAKER_COOLDOWN=2.0,
+                LLM_HEDGE_QUANTILE=0.0)
+
+    results = await scenario(server, args, {"fail_rate": 0.3}, complete, **base)
+    ok &= report("30% of requests fail with 503", results, DEFAULT_REPLY)
+
+    results = await scenario(server, args, {"hang_rate": 0.1}, complete, **base)
+    ok &= report("10% of requests hang (0.5s attempt timeout)", results, DEFAULT_REPLY)
+
+    results = await scenario(server, args, {"down_models": [beck.MODEL]}, complete, **base)
+    ok &= report("primary model down, fallback healthy", results, DEFAULT_REPLY)
+    late = sorted(elapsed for _, elapsed in results[len(results) // 2:])
+    if percentile(late, 0.5) > 3 * args.latency:
+        print("  FAIL: calls kept waiting on the dead model after its circuit opened")
+        ok = False
+
+    results = await scenario(server, args, {"down_models": [beck.MODEL, FALLBACK_MODEL]}, reply, **base)
+    ok &= report("every model down (caller gets the fallback line)", results, beck.FALLBACK_REPLY)
+    late = [elapsed for _, elapsed in results[len(results) // 2:]]
+    print(f"  once the circuits are open: p50 {percentile(late, 0.5) * 1000:.1f}ms")
+    if percentile(late, 0.5) > 0.01:
+        print("  FAIL: open circuits did not fail fast")
+        ok = False
+
+    tail = {"slow_rate": 0.05, "slow_latency": 1.0}
+    results = await scenario(server, args, tail, complete, **{**base, "LLM_TIMEOUT": 5.0})
+    ok &= report("5% slow tail (1s), no hedging", results, DEFAULT_REPLY)
+    unhedged = sum(1 for _, elapsed in results if elapsed >= tail["slow_latency"])
+    results = await scenario(server, args, tail, complete, warmup=beck.HEDGE_MIN_SAMPLES,
+                             **{**base, "LLM_TIMEOUT": 5.0, "LLM_HEDGE_QUANTILE": 0.9})
+    ok &= report("5% slow tail (1s), hedged at p90", results, DEFAULT_REPLY)
+    hedged = sum(1 for _, elapsed in results if elapsed >= tail["slow_latency"])
+    print(f"  calls taking the full slow latency: {unhedged} without hedging, {hedged} with")
+    if hedged * 2 > unhedged:
+        print("  FAIL: hedging did not cut the tail")
+        ok = False
+
+    results = await scenario(server, args, {"fail_rate": 0.3}, stream, **base)
+    ok &= report("streamed replies, 30% of requests fail with 503", results, DEFAULT_REPLY)
+    return ok
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Model backend resilience against a fault-injecting stub")
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    logging.disable(logging.ERROR)
+    server, base_url = start_stub_server(latency=args.latency, token_latency=0.0)
+    beck.FIREWORKS_BASE_URL = base_url
+    ok = asyncio.run(main(server, args))
+    server.shutdown()
+    if not ok:
+        sys.exit("FAIL")
@@ -0,0 +1,47 @@
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import beck
+from stub_model_server import DEFAULT_REPLY, start_stub_server
+
+# Shows that N chats waiting on the model overlap instead of queueing:
+# wall time should stay close to one model latency, not N of them.
+
+async def run_chats(chats: int) -> float:
+    # Warm the pooled client first so its one-off setup is not measured.
+    await beck.get_ai_response({"messages": []}, "warm up")
+    start = time.perf_counter()
+    replies = await asyncio.gather(*(
+        beck.get_ai_response({"messages": []}, f"hi from chat {i}") for i in range(chats)
+    ))
+    elapsed = time.perf_counter() - start
+    await beck.close_http_client()
+    assert all(r == DEFAULT_REPLY for r in replies), "some chats got the fallback reply"
+    return elapsed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.5)
+    args = parser.parse_args()
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    server, base_url = start_stub_server(latency=args.latency)
+    beck.FIREWORKS_BASE_URL = base_url
+    beck.LLM_MAX_CONCURRENCY = max(beck.LLM_MAX_CONCURRENCY, args.chats)
+
+    elapsed = asyncio.run(run_chats(args.chats))
+    serial = args.chats * args.latency
+    print(f"{args.chats} concurrent chats, model latency {args.latency:.2f}s")
+    print(f"  wall time:   {elapsed:.2f}s")
+    print(f"  serial time: {serial:.2f}s (what a blocking client would take)")
+    print(f"  speedup:     {serial / elapsed:.1f}x")
+    server.shutdown()
+    if elapsed > 2 * args.latency:
+        sys.exit("FAIL: chats did not overlap")
@@ -0,0 +1,58 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import beck
+
+# Grows one conversation to --messages turns and reports, at checkpoints,
+# how large the prompt is and how long build_context takes. The model call
+# that updates the summary is replaced by a local fold that keeps the last
+# SUMMARY_MAX_TOKENS worth of text, so only the context builder is measured.
+
+WORDS = "hmm lol okay maybe books coffee rain honestly tomorrow poetry class you me".split()
+
+def fake_summarize(user_data: dict, turns: list):
+    text = (user_data.get("summary") or "") + " " + " ".join(t["text"] for t in turns)
+    user_data["summary"] = text[-beck.SUMMARY_MAX_TOKENS * 4:]
+    user_data["summary_until"] = turns[-1]["timestamp"]
+
+def random_text(rng: random.Random) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 40)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=12000)
+    parser.add_argument("--repeat", type=int, default=200, help="builds timed per checkpoint")
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    rng = random.Random(1)
+    checkpoints = {100, 1000, 5000, 10000, args.messages}
+    user_data = beck.load_user_data(1, 1)
+    naive_tokens = beck.count_tokens(beck.SYSTEM_PROMPT)
+
+    print(f"budget {beck.CONTEXT_TOKEN_BUDGET} tokens")
+    print(f"{'history':>8} {'naive prompt':>13} {'prompt':>7} {'kept turns':>11} {'build time':>11}")
+    for i in range(1, args.messages + 1):
+        text = random_text(rng)
+        naive_tokens += beck.count_tokens(text)
+        history, overflow = beck.build_context(user_data, text)
+        if overflow:
+            fake_summarize(user_data, overflow)
+        beck.append_message(user_data, "user" if i % 2 else "bot", text)
+        if i % 1000 == 0:
+            beck.flush_user_data()
+
+        if i in checkpoints:
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                history, _ = beck.build_context(user_data, text)
+            elapsed = (time.perf_counter() - start) / args.repeat
+            prompt_tokens = sum(beck.count_tokens(m["content"]) for m in history)
+            print(f"{i:>8} {naive_tokens:>13} {prompt_tokens:>7} {len(user_data['messages']):>11} "
+                  f"{elapsed * 1e6:>9.1f}us")
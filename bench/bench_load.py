@@ -0,0 +1,240 @@
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update
+from telegram.ext import Application
+
+import beck
+from fakes import BOT_ID, BOT_USERNAME, FakeTelegramRequest
+from stub_model_server import start_stub_server
+
+# Offline end-to-end load test: synthetic updates go through the Application
+# built by beck.build_application, the model is the local stub server and the
+# Bot API is answered by FakeTelegramRequest. Reports throughput, reply
+# latency percentiles and disk bytes written per message.
+
+WORDS = "hey so honestly today was weird lol what are you reading maybe coffee later".split()
+
+class UpdateFactory:
+    def __init__(self, users: int, groups: int, seed: int):
+        self.rng = random.Random(seed)
+        self.users = users
+        self.groups = groups
+        self.update_id = 0
+        self.message_id = 1000
+
+    def user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}",
+                "username": f"user{user_id}", "language_code": "en"}
+
+    def words(self, n: int) -> str:
+        return " ".join(self.rng.choice(WORDS) for _ in range(n))
+
+    def build(self, chat: dict, user_id: int, parts: list, reply_to_bot: bool = False) -> dict:
+        # parts: plain strings or (entity_type, text) tuples
+        text, entities = "", []
+        for part in parts:
+            if text:
+                text += " "
+            if isinstance(part, tuple):
+                entities.append({"type": part[0], "offset": len(text), "length": len(part[1])})
+                part = part[1]
+            text += part
+        self.update_id += 1
+        self.message_id += 1
+        message = {"message_id": self.message_id, "date": int(time.time()), "chat": chat,
+                   "from": self.user(user_id), "text": text}
+        if entities:
+            message["entities"] = entities
+        if reply_to_bot:
+            message["reply_to_message"] = {
+                "message_id": 1, "date": int(time.time()), "chat": chat, "text": "earlier reply",
+                "from": {"id": BOT_ID, "is_bot": True, "first_name": "Beck", "username": BOT_USERNAME}
+            }
+        return {"update_id": self.update_id, "message": message}
+
+    def next(self) -> tuple:
+        # Returns (update dict, chat id, whether the bot should answer)
+        user_id = self.rng.randint(1, self.users)
+        kind = self.rng.random()
+        if kind < 0.4:
+            chat = {"id": user_id, "type": "private", "first_name": f"User{user_id}"}
+            return self.build(chat, user_id, [self.words(self.rng.randint(2, 20))]), user_id, True
+        group_id = -self.rng.randint(1, self.groups)
+        chat = {"id": group_id, "type": "supergroup", "title": f"Group {-group_id}"}
+        if kind < 0.6:
+            parts = [("mention", f"@{BOT_USERNAME}"), self.words(self.rng.randint(2, 15))]
+            return self.build(chat, user_id, parts), group_id, True
+        if kind < 0.7:
+            return self.build(chat, user_id, [self.words(8)], reply_to_bot=True), group_id, True
+        # Group chatter not meant for the bot, heavy on entities
+        parts = [self.words(3)]
+        for _ in range(self.rng.randint(3, 12)):
+            choice = self.rng.random()
+            if choice < 0.3:
+                parts.append(("hashtag", f"#{self.rng.choice(WORDS)}{self.rng.randint(0, 50)}"))
+            elif choice < 0.6:
+                parts.append(("mention", f"@user{self.rng.randint(1, self.users)}"))
+            elif choice < 0.8:
+                parts.append(("url", f"https://example.com/{self.rng.randint(0, 999)}"))
+            else:
+                parts.append(("phone_number", f"+1555{self.rng.randint(1000000, 9999999)}"))
+        return self.build(chat, user_id, parts), group_id, False
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+async def run(args) -> dict:
+    request = FakeTelegramRequest(latency=args.api_latency)
+    builder = (
+        Application.builder()
+        .token("123456:BENCHMARK")
+        .request(request)
+        .get_updates_request(FakeTelegramRequest())
+    )
+    app = beck.build_application(builder)
+    factory = UpdateFactory(args.users, args.groups, args.seed)
+
+    addressed = []
+    async with app:
+        await beck.on_startup(app)
+        await app.start()
+
+        start = time.perf_counter()
+        for i in range(args.messages):
+            data, chat_id, answers = factory.next()
+            put_at = time.perf_counter()
+            await app.update_queue.put(Update.de_json(data, app.bot))
+            if answers:
+                addressed.append((chat_id, put_at))
+            if args.rate:
+                await asyncio.sleep(max(0.0, start + (i + 1) / args.rate - time.perf_counter()))
+
+        # Every update counted by handle_message means ingest is done
+        while sum(v for (name, _), v in beck.metrics.counters.items() if name == "updates_total") < args.messages:
+            await asyncio.sleep(0.01)
+        ingest_time = time.perf_counter() - start
+
+        # Wait for a reply after every addressed message
+        deadline = time.perf_counter() + args.timeout
+        latencies = []
+        while time.perf_counter() < deadline:
+            sends = defaultdict(list)
+            for sent_at, chat_id, _, _ in request.sends:
+                sends[chat_id].append(sent_at)
+            latencies = []
+            for chat_id, put_at in addressed:
+                times = sends.get(chat_id, [])
+                index = bisect_left(times, put_at)
+                if index < len(times):
+                    latencies.append(times[index] - put_at)
+            if len(latencies) == len(addressed):
+                break
+            # Over-limit turns are dropped quietly after the first notice,
+            # so with limits on an idle pipeline means everything is done
+            limits_on = args.user_rate or args.user_daily_tokens
+            idle = not beck.conversations_busy and not beck.outbound.pending() and \
+                not any(q.qsize() for q in beck.conversation_queues.values())
+            if limits_on and idle:
+                break
+            await asyncio.sleep(0.05)
+        total_time = time.perf_counter() - start
+
+        await app.stop()
+        await beck.on_stop(app)
+    await beck.on_shutdown(app)
+
+    return {
+        "ingest_time": ingest_time,
+        "total_time": total_time,
+        "addressed": len(addressed),
+        "answered": len(latencies),
+        "latencies": latencies,
+        "shed": {dict(labels)["reason"]: v for (name, labels), v in beck.metrics.counters.items()
+                 if name == "admission_shed_total"},
+        "limited": {dict(labels)["reason"]: v for (name, labels), v in beck.metrics.counters.items()
+                    if name == "limited_total"},
+        "shed_private": sum(1 for _, chat_id, _, text in request.sends
+                            if text == beck.SHED_REPLY and chat_id > 0),
+        "sends": len(request.sends),
+        "model_requests": beck.metrics.counters.get(("model_requests_total", ()), 0),
+        "disk_bytes": beck.metrics.counters.get(("disk_bytes_written_total", ()), 0),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline load test for beck.py")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=0, help="updates per second, 0 = as fast as possible")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.2, help="model latency before the first token")
+    parser.add_argument("--token-latency", type=float, default=0.005)
+    parser.add_argument("--no-stream", action="store_true", help="wait for whole replies instead of streaming")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="fake Bot API latency")
+    parser.add_argument("--concurrency", type=int, default=beck.LLM_MAX_CONCURRENCY, help="max model calls in flight")
+    parser.add_argument("--burst-window", type=float, default=0.0)
+    parser.add_argument("--send-rate", type=float, default=1000, help="global send limit, default effectively off")
+    parser.add_argument("--admission-queue", type=int, default=100000,
+                        help="turns allowed to wait for the model, default effectively off")
+    parser.add_argument("--admission-wait", type=float, default=beck.ADMISSION_MAX_WAIT,
+                        help="seconds a turn may wait for the model before it is shed")
+    parser.add_argument("--user-rate", type=float, default=0, help="model replies per user per minute, 0 = off")
+    parser.add_argument("--user-daily-tokens", type=int, default=0, help="daily token budget per user, 0 = off")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    os.chdir(tempfile.mkdtemp(prefix="beck-bench-"))
+    server, base_url = start_stub_server(latency=args.latency, token_latency=args.token_latency)
+    beck.FIREWORKS_BASE_URL = base_url
+    beck.LLM_MAX_CONCURRENCY = args.concurrency
+    beck.STREAM_REPLIES = not args.no_stream
+    beck.BURST_WINDOW = args.burst_window
+    beck.SEND_GLOBAL_RATE = args.send_rate
+    beck.SEND_CHAT_RATE = beck.SEND_GROUP_RATE = args.send_rate
+    beck.TYPING_DELAY = 0.0
+    beck.ADMISSION_MAX_QUEUE = args.admission_queue
+    beck.ADMISSION_MAX_WAIT = args.admission_wait
+    beck.USER_RATE_PER_MIN = args.user_rate
+    beck.USER_DAILY_TOKENS = args.user_daily_tokens
+    beck.CHAT_RATE_PER_MIN = beck.CHAT_DAILY_TOKENS = 0
+    beck.outbound = beck.OutboundScheduler()
+    beck.admission = beck.AdmissionQueue()
+
+    result = asyncio.run(run(args))
+    server.shutdown()
+
+    latencies = result["latencies"]
+    print(f"{args.messages} updates ({result['addressed']} addressed to the bot), "
+          f"model latency {args.latency}s, {'batch' if args.no_stream else 'streaming'}")
+    print(f"  ingest:            {args.messages / result['ingest_time']:.0f} updates/s")
+    print(f"  end to end:        {args.messages / result['total_time']:.0f} updates/s "
+          f"({result['total_time']:.2f}s)")
+    print(f"  answered:          {result['answered']}/{result['addressed']} "
+          f"({result['model_requests']:g} model calls, {result['sends']} messages sent)")
+    print(f"  reply latency:     p50 {percentile(latencies, 0.5) * 1000:.0f}ms  "
+          f"p95 {percentile(latencies, 0.95) * 1000:.0f}ms  p99 {percentile(latencies, 0.99) * 1000:.0f}ms")
+    shed = result["shed"]
+    print(f"  shed:              {sum(shed.values()):g} "
+          f"(queue full {shed.get('depth', 0):g}, waited too long {shed.get('wait', 0):g}, "
+          f"{result['shed_private']} in private chats)")
+    limited = result["limited"]
+    print(f"  over limit:        {sum(limited.values()):g} "
+          f"(rate {limited.get('rate', 0):g}, daily budget {limited.get('daily', 0):g})")
+    print(f"  disk written:      {result['disk_bytes'] / args.messages:.0f} bytes/update")
+    if result["answered"] < result["addressed"] and not (args.user_rate or args.user_daily_tokens):
+        sys.exit("FAIL: some messages were never answered")
@@ -0,0 +1,70 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import beck
+from fakes import RecordingBot
+
+# Pushes replies for many private chats and groups through the outbound
+# scheduler at once, against a bot that records send times and hits flood
+# control once, then checks the recorded sends against the configured limits.
+
+def max_in_window(times: list, window: float) -> int:
+    best, start = 0, 0
+    for end in range(len(times)):
+        while times[end] - times[start] >= window:
+            start += 1
+        best = max(best, end - start + 1)
+    return best
+
+async def run(private_chats: int, groups: int, chunks: int, bot: RecordingBot) -> float:
+    start = time.monotonic()
+    for chat_id in range(1, private_chats + 1):
+        for i in range(chunks):
+            beck.outbound.enqueue(bot, chat_id, "private", f"chunk {i}")
+    for chat_id in range(-1, -groups - 1, -1):
+        for i in range(chunks):
+            beck.outbound.enqueue(bot, chat_id, "supergroup", f"chunk {i}", reply_to_message_id=1)
+    enqueue_time = time.monotonic() - start
+    await beck.outbound.drain()
+    print(f"enqueued {(private_chats + groups) * chunks} messages in {enqueue_time * 1000:.1f}ms")
+    return time.monotonic() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--private-chats", type=int, default=60)
+    parser.add_argument("--groups", type=int, default=5)
+    parser.add_argument("--chunks", type=int, default=4)
+    args = parser.parse_args()
+
+    bot = RecordingBot(flood_after=20, retry_after=1)
+    elapsed = asyncio.run(run(args.private_chats, args.groups, args.chunks, bot))
+
+    times = [t for t, _, _ in bot.sends]
+    by_chat = defaultdict(list)
+    for t, chat_id, _ in bot.sends:
+        by_chat[chat_id].append(t)
+    gaps = [b - a for ts in by_chat.values() for a, b in zip(ts, ts[1:])]
+    group_peak = max(max_in_window(ts, 60) for chat_id, ts in by_chat.items() if chat_id < 0)
+
+    failures = []
+    if len(bot.sends) != (args.private_chats + args.groups) * args.chunks:
+        failures.append("some messages were lost")
+    if max_in_window(times, 1.0) > beck.SEND_GLOBAL_RATE + 1:
+        failures.append("global rate exceeded")
+    if min(gaps) < beck.TYPING_DELAY - 0.01:
+        failures.append("typing delay not respected")
+    if group_peak > beck.SEND_BURST + beck.SEND_GROUP_RATE * 60 + 1:
+        failures.append("group rate exceeded")
+
+    print(f"sent {len(bot.sends)} messages in {elapsed:.2f}s (one RetryAfter of {bot.retry_after}s)")
+    print(f"  peak global rate:     {max_in_window(times, 1.0)}/s (limit {beck.SEND_GLOBAL_RATE:g}/s)")
+    print(f"  min gap within chat:  {min(gaps):.2f}s (typing delay {beck.TYPING_DELAY:g}s)")
+    print(f"  peak per group:       {group_peak}/min (limit {beck.SEND_GROUP_RATE * 60:g}/min)")
+    if failures:
+        sys.exit("FAIL: " + ", ".join(failures))
@@ -0,0 +1,108 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram.ext import Application
+
+import beck
+from bench_load import UpdateFactory
+from fakes import FakeTelegramRequest
+from stub_model_server import start_stub_server
+
+# Throughput of the sharded mode: the same synthetic updates are routed by a
+# ShardRouter to 1, 2, 4... worker processes, each running the full
+# Application against the stub model server and a fake Bot API. Time runs
+# from the first dispatch until every worker has drained and exited.
+# Scaling is bounded by the cores available (os.cpu_count()).
+
+class BenchAppFactory:
+    # Module-level class so it also pickles under the "spawn" start method
+    def __call__(self) -> Application:
+        builder = (
+            Application.builder()
+            .token("123456:BENCHMARK")
+            .request(FakeTelegramRequest())
+            .get_updates_request(FakeTelegramRequest())
+        )
+        return beck.build_application(builder)
+
+def run(workers: int, args) -> dict:
+    data_dir = tempfile.mkdtemp(prefix=f"beck-shards-{workers}-")
+    os.chdir(data_dir)
+    beck.ensure_data_dir()
+
+    router = beck.ShardRouter(workers, BenchAppFactory())
+    router.start()
+    factory = UpdateFactory(args.users, args.groups, args.seed)
+    updates = [factory.next() for _ in range(args.messages)]
+
+    start = time.perf_counter()
+    for data, _, _ in updates:
+        message = data["message"]
+        router.dispatch(message["chat"]["id"], message["from"]["id"], data)
+    router.stop()
+    elapsed = time.perf_counter() - start
+
+    # Every conversation spoken to should have a bot turn in its log
+    replied = set()
+    for path in glob.glob(os.path.join(beck.LOG_DIR, "*.jsonl")):
+        with open(path, encoding="utf-8") as f:
+            if any(json.loads(line)["from"] == "bot" for line in f):
+                replied.add(os.path.basename(path)[:-len(".jsonl")])
+    addressed = {
+        beck.make_user_key(chat_id, data["message"]["from"]["id"])
+        for data, chat_id, answers in updates if answers
+    }
+    return {
+        "elapsed": elapsed,
+        "routed": router.routed,
+        "addressed": len(addressed),
+        "replied": len(addressed & replied),
+        "exit_codes": [p.exitcode for p in router.processes],
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sharded throughput benchmark for beck.py")
+    parser.add_argument("--workers", default="1,2,4", help="comma-separated worker counts")
+    parser.add_argument("--messages", type=int, default=3000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.05, help="model latency before the first token")
+    parser.add_argument("--token-latency", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    server, base_url = start_stub_server(latency=args.latency, token_latency=args.token_latency)
+    # Set before forking so every worker inherits the bench configuration
+    beck.FIREWORKS_BASE_URL = base_url
+    beck.BURST_WINDOW = 0.0
+    beck.TYPING_DELAY = 0.0
+    beck.SEND_GLOBAL_RATE = beck.SEND_CHAT_RATE = beck.SEND_GROUP_RATE = 1000
+    beck.USER_RATE_PER_MIN = beck.CHAT_RATE_PER_MIN = 0
+    beck.outbound = beck.OutboundScheduler()
+    # Measure throughput, not load shedding: let every turn wait for the model
+    beck.ADMISSION_MAX_QUEUE = 100000
+    beck.admission = beck.AdmissionQueue()
+
+    print(f"{args.messages} updates, model latency {args.latency}s, {os.cpu_count()} CPUs")
+    failed = False
+    baseline = None
+    for workers in (int(w) for w in args.workers.split(",")):
+        result = run(workers, args)
+        rate = args.messages / result["elapsed"]
+        baseline = baseline or rate
+        print(f"  {workers} worker(s): {rate:6.0f} updates/s  x{rate / baseline:.2f}  "
+              f"replied {result['replied']}/{result['addressed']}  routed {result['routed']}")
+        if result["replied"] < result["addressed"] or any(result["exit_codes"]):
+            failed = True
+    server.shutdown()
+    if failed:
+        sys.exit("FAIL: a worker exited abnormally or a conversation went unanswered")
@@ -0,0 +1,125 @@
+import argparse
+import asyncio
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import beck
+from bench_load import percentile
+
+# Startup costs: how long `import beck` takes in a fresh interpreter with and
+# without the network stacks, and what the first message after a restart
+# costs per user (record load + context build) with a cold cache versus
+# after warm_up_cache has preloaded the most recently active users. Files
+# sit in the OS page cache either way, so the cold numbers are a lower bound.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def time_import(code: str, runs: int) -> tuple:
+    # Best of `runs` fresh interpreters; the snippet prints its own timing
+    best, modules = None, None
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", code], cwd=ROOT, check=True,
+                                capture_output=True, text=True).stdout.split()
+        elapsed = float(output[0])
+        best = elapsed if best is None else min(best, elapsed)
+        modules = output[1:]
+    return best, modules
+
+IMPORT_BECK = (
+    "import sys, time; start = time.perf_counter(); import beck; "
+    "print(time.perf_counter() - start, 'telegram' in sys.modules, 'httpx' in sys.modules)"
+)
+IMPORT_FULL = (
+    "import sys, time; start = time.perf_counter(); import beck; "
+    "beck.build_application(); beck.get_http_client(); "
+    "print(time.perf_counter() - start, 'telegram' in sys.modules, 'httpx' in sys.modules)"
+)
+
+def make_dataset(users: int, turns: int, seed: int) -> list:
+    # Returns the user keys, most recently active first
+    rng = random.Random(seed)
+    beck.ensure_data_dir()
+    now = time.time()
+    keys = []
+    for i in range(users):
+        chat_id = -1000 - i % 50 if i % 3 else 10_000 + i
+        user_id = 10_000 + i
+        user_key = beck.make_user_key(chat_id, user_id)
+        last_seen = now - i * 60
+        profile = {"chat_id": chat_id, "user_id": user_id, "username": f"user{i}",
+                   "message_count": turns, "hashtags": [], "mentions": [], "links": [],
+                   "phone_numbers": [], "summary": "They like books and rainy days."}
+        with open(beck.get_user_file(user_key), "w", encoding="utf-8") as f:
+            f.write(beck.profile_json(profile))
+        os.utime(beck.get_user_file(user_key), (last_seen, last_seen))
+        with open(beck.get_log_file(user_key), "w", encoding="utf-8") as f:
+            for n in range(turns):
+                words = " ".join(rng.choice(("hey", "book", "rain", "coffee", "tonight")) for _ in range(12))
+                f.write(beck.message_line({"from": "bot" if n % 2 else "user", "text": words,
+                                           "timestamp": f"2026-01-01T00:00:{n % 60:02d}", "tokens": 20}))
+        keys.append(user_key)
+    return keys
+
+def first_messages(user_keys: list) -> list:
+    # What the handler pays before the model call for each user's first message
+    latencies = []
+    for user_key in user_keys:
+        chat_id, user_id = (int(part) for part in user_key.rsplit("_", 1))
+        start = time.perf_counter()
+        data = beck.load_user_data(chat_id, user_id)
+        beck.build_context(data, "hi again")
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def report(name: str, latencies: list):
+    print(f"  {name:<22} p50 {percentile(latencies, 0.5) * 1000:6.2f}ms  "
+          f"p99 {percentile(latencies, 0.99) * 1000:6.2f}ms  total {sum(latencies):.2f}s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Startup time and warm-up benchmark for beck.py")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--turns", type=int, default=200, help="turns per conversation log")
+    parser.add_argument("--active", type=int, default=500, help="returning users, most recent first")
+    parser.add_argument("--runs", type=int, default=5, help="interpreters per import measurement")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    failed = False
+    light, modules = time_import(IMPORT_BECK, args.runs)
+    print(f"import beck:                 {light * 1000:6.0f}ms  (telegram loaded: {modules[0]}, httpx loaded: {modules[1]})")
+    if modules != ["False", "False"]:
+        print("  FAIL: importing beck loaded the network stacks")
+        failed = True
+    full, _ = time_import(IMPORT_FULL, args.runs)
+    print(f"import beck + build the bot: {full * 1000:6.0f}ms")
+
+    logging.getLogger().setLevel(logging.WARNING)
+    os.chdir(tempfile.mkdtemp(prefix="beck-startup-"))
+    print(f"\n{args.users} users with {args.turns} turns each, {args.active} return after a restart")
+    returning = make_dataset(args.users, args.turns, args.seed)[:args.active]
+
+    beck.user_cache = beck.UserCache(args.active)
+    cold = first_messages(returning)
+
+    beck.user_cache = beck.UserCache(args.active)
+    start = time.perf_counter()
+    asyncio.run(beck.warm_up_cache(args.active))
+    warm_up = time.perf_counter() - start
+    misses = beck.user_cache.misses
+    warm = first_messages(returning)
+
+    print(f"  warm-up (background):  {warm_up:.2f}s for {len(beck.user_cache.records)} records")
+    report("first message, cold", cold)
+    report("first message, warmed", warm)
+    if beck.user_cache.misses > misses:
+        print(f"  FAIL: {beck.user_cache.misses - misses} returning users missed the warmed cache")
+        failed = True
+    if failed:
+        sys.exit("FAIL")
@@ -0,0 +1,109 @@
+import argparse
+import asyncio
+import glob
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+from telegram.ext import Application
+
+import beck
+from bench_load import UpdateFactory
+from fakes import FakeTelegramRequest
+from stub_model_server import start_stub_server
+
+# Runs the bot in webhook mode on localhost, POSTs recorded update JSON to it
+# concurrently and asks it to stop while replies are still being generated.
+# Passes if every addressed update was answered and every user was flushed
+# to disk by the graceful drain.
+
+async def post_updates(port: int, updates: list, concurrency: int) -> list:
+    url = f"http://127.0.0.1:{port}{beck.WEBHOOK_PATH}"
+    headers = {"X-Telegram-Bot-Api-Secret-Token": beck.WEBHOOK_SECRET}
+    limit = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient() as client:
+        async def post(update):
+            async with limit:
+                response = await client.post(url, json=update, headers=headers)
+                return response.status_code
+        return await asyncio.gather(*(post(u) for u in updates))
+
+async def run(args) -> dict:
+    request = FakeTelegramRequest()
+    builder = (
+        Application.builder()
+        .token("123456:BENCHMARK")
+        .request(request)
+        .get_updates_request(FakeTelegramRequest())
+    )
+    app = beck.build_application(builder)
+    stop = asyncio.Event()
+    server_task = asyncio.create_task(beck.run_webhook(app, stop))
+    await asyncio.sleep(0.5)
+
+    factory = UpdateFactory(args.users, args.groups, args.seed)
+    generated = [factory.next() for _ in range(args.messages)]
+    updates = [u for u, _, _ in generated]
+    addressed_chats = {chat_id for _, chat_id, answers in generated if answers}
+    users = {(u["message"]["chat"]["id"], u["message"]["from"]["id"]) for u in updates}
+
+    start = time.perf_counter()
+    statuses = await post_updates(beck.WEBHOOK_PORT, updates, args.concurrency)
+    post_time = time.perf_counter() - start
+
+    # Stop right away: replies are still in flight and must be finished
+    stop.set()
+    await server_task
+    total_time = time.perf_counter() - start
+
+    answered_chats = {chat_id for _, chat_id, _, _ in request.sends}
+    files = {os.path.basename(p) for p in glob.glob(os.path.join(beck.DATA_DIR, "*.json"))}
+    return {
+        "post_time": post_time,
+        "total_time": total_time,
+        "accepted": statuses.count(200),
+        "unanswered": len(addressed_chats - answered_chats),
+        "addressed": len(addressed_chats),
+        "unflushed": len({f"{beck.make_user_key(c, u)}.json" for c, u in users} - files),
+        "users": len(users),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50, help="parallel POSTs")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--groups", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--port", type=int, default=18443)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    os.chdir(tempfile.mkdtemp(prefix="beck-webhook-"))
+    server, base_url = start_stub_server(latency=args.latency)
+    beck.FIREWORKS_BASE_URL = base_url
+    beck.WEBHOOK_URL = ""
+    beck.WEBHOOK_LISTEN = "127.0.0.1"
+    beck.WEBHOOK_PORT = args.port
+    beck.WEBHOOK_SECRET = "bench-secret"
+    beck.BURST_WINDOW = 0.2
+    beck.TYPING_DELAY = 0.0
+    beck.SEND_GLOBAL_RATE = beck.SEND_CHAT_RATE = beck.SEND_GROUP_RATE = 1000
+    beck.outbound = beck.OutboundScheduler()
+
+    result = asyncio.run(run(args))
+    server.shutdown()
+
+    print(f"{result['accepted']}/{args.messages} updates accepted in {result['post_time']:.2f}s "
+          f"({args.messages / result['post_time']:.0f} updates/s)")
+    print(f"graceful stop finished after {result['total_time']:.2f}s")
+    print(f"  chats left unanswered: {result['unanswered']}/{result['addressed']}")
+    print(f"  users not flushed:     {result['unflushed']}/{result['users']}")
+    if result["accepted"] < args.messages or result["unanswered"] or result["unflushed"]:
+        sys.exit("FAIL")
@@ -0,0 +1,78 @@
+import asyncio
+import json
+import time
+
+from telegram.error import RetryAfter
+from telegram.request import BaseRequest
+
+# Stand-ins for the Telegram side of the bot, used by the benchmarks.
+
+BOT_ID = 777000
+BOT_USERNAME = "beck_bot"
+
+class RecordingBot:
+    # Records every send with its monotonic timestamp instead of calling
+    # Telegram. flood_after makes the n-th send raise RetryAfter once.
+    def __init__(self, flood_after: int = None, retry_after: int = 1):
+        self.sends = []
+        self.flood_after = flood_after
+        self.retry_after = retry_after
+        self.calls = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls += 1
+        if self.flood_after is not None and self.calls == self.flood_after:
+            raise RetryAfter(self.retry_after)
+        self.sends.append((time.monotonic(), chat_id, text))
+
+class FakeTelegramRequest(BaseRequest):
+    # Transport for a real python-telegram-bot Bot that answers Bot API calls
+    # locally, after `latency` seconds, and records every sendMessage.
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.sends = []
+        self.calls = {}
+        self.next_message_id = 1
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        params = {}
+        if request_data is not None:
+            params = {k: json.loads(v) if v[:1] in "{[" else v
+                      for k, v in request_data.json_parameters.items()}
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if endpoint == "getMe":
+            result = {"id": BOT_ID, "is_bot": True, "first_name": "Beck", "username": BOT_USERNAME}
+        elif endpoint == "sendMessage":
+            chat_id = int(params["chat_id"])
+            reply_to = params.get("reply_to_message_id")
+            if reply_to is None and isinstance(params.get("reply_parameters"), dict):
+                reply_to = params["reply_parameters"].get("message_id")
+            self.sends.append((time.perf_counter(), chat_id, int(reply_to) if reply_to else None, params["text"]))
+            result = {
+                "message_id": self.next_message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+                "from": {"id": BOT_ID, "is_bot": True, "first_name": "Beck", "username": BOT_USERNAME},
+                "text": params["text"]
+            }
+            self.next_message_id += 1
+        elif endpoint == "getUserProfilePhotos":
+            result = {"total_count": 0, "photos": []}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode("utf-8")
@@ -0,0 +1,159 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the Fireworks chat completions endpoint.
+# Speaks just enough of the OpenAI-compatible API for beck.py, and can
+# inject faults: 503s, requests that hang, slow tail requests, and models
+# that are down (503) or unknown (404).
+
+DEFAULT_REPLY = "oh hey! just finished rereading some Sylvia Plath... what about you? any good book recs?"
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if not self.path.endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        server = self.server
+        model = request.get("model")
+        with server.lock:
+            server.requests += 1
+            server.models[model] = server.models.get(model, 0) + 1
+            roll = server.rng.random()
+
+        if model in server.unknown_models:
+            self.send_error(404, "model not found")
+            return
+        if model in server.down_models or roll < server.fail_rate:
+            time.sleep(server.latency / 10)
+            self.send_error(503, "overloaded")
+            return
+        roll -= server.fail_rate
+        if roll < server.hang_rate:
+            time.sleep(server.hang_time)
+            return
+        roll -= server.hang_rate
+        time.sleep(server.slow_latency if roll < server.slow_rate else server.latency)
+
+        reply = self.server.reply
+        if request.get("stream"):
+            self.stream_reply(request, reply)
+            return
+        prompt_tokens = sum(len(m.get("content", "")) // 4 for m in request.get("messages", []))
+        completion_tokens = len(reply) // 4
+        body = json.dumps({
+            "id": f"stub-{self.server.requests}",
+            "object": "chat.completion",
+            "model": request.get("model"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": reply},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream_reply(self, request: dict, reply: str):
+        # Server-sent events, one word per chunk, token_latency apart
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        words = reply.split(" ")
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(self.server.token_latency)
+            chunk = {
+                "id": f"stub-{self.server.requests}",
+                "object": "chat.completion.chunk",
+                "model": request.get("model"),
+                "choices": [{
+                    "index": 0,
+                    "delta": {"content": word if i == 0 else " " + word},
+                    "finish_reason": None
+                }]
+            }
+            self.write_chunk(f"data: {json.dumps(chunk)}\n\n")
+        self.write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def write_chunk(self, text: str):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def handle_error(self, request, client_address):
+        # Clients that gave up on a hanging or hedged request close early
+        pass
+
+    def set_faults(self, fail_rate: float = 0.0, hang_rate: float = 0.0, hang_time: float = 60.0,
+                   slow_rate: float = 0.0, slow_latency: float = 5.0,
+                   down_models: tuple = (), unknown_models: tuple = ()):
+        self.fail_rate = fail_rate
+        self.hang_rate = hang_rate
+        self.hang_time = hang_time
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.down_models = set(down_models)
+        self.unknown_models = set(unknown_models)
+
+def start_stub_server(port: int = 0, latency: float = 0.5, token_latency: float = 0.02,
+                      reply: str = DEFAULT_REPLY, seed: int = 1):
+    server = StubServer(("127.0.0.1", port), StubHandler)
+    server.latency = latency
+    server.token_latency = token_latency
+    server.reply = reply
+    server.requests = 0
+    server.models = {}
+    server.lock = threading.Lock()
+    server.rng = random.Random(seed)
+    server.set_faults()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    return server, base_url
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stub for the Fireworks chat completions API")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds before the first token")
+    parser.add_argument("--token-latency", type=float, default=0.02, help="seconds between streamed tokens")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="share of requests answered with 503")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="share of requests that never answer")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="share of requests that take --slow-latency")
+    parser.add_argument("--slow-latency", type=float, default=5.0)
+    parser.add_argument("--down-models", default="", help="comma-separated models that always get 503")
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(args.port, args.latency, args.token_latency)
+    server.set_faults(args.fail_rate, args.hang_rate, slow_rate=args.slow_rate, slow_latency=args.slow_latency,
+                      down_models=[m for m in args.down_models.split(",") if m])
+    print(f"Stub model server listening on {base_url} (latency {args.latency}s)")
+    print(f"Run the bot with FIREWORKS_BASE_URL={base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,28 @@
+import argparse
+import os
+
+import beck
+
+# Moves old turns out of the message logs in user_data/logs/ into gzip
+# segments under user_data/archive/, keeping the newest turns live. The bot
+# can do the same on a schedule (COMPACT_INTERVAL); stop it before running
+# this by hand, since a running bot may be appending to the same logs.
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archive old turns of user_data/logs into compressed segments")
+    parser.add_argument("--data-dir", default=beck.DATA_DIR)
+    parser.add_argument("--keep-turns", type=int, default=beck.COMPACT_KEEP_TURNS,
+                        help="turns kept live per conversation, 0 = no count limit")
+    parser.add_argument("--max-age-days", type=float, default=beck.COMPACT_MAX_AGE_DAYS,
+                        help="turns older than this are archived, 0 = no age limit")
+    args = parser.parse_args()
+
+    beck.DATA_DIR = args.data_dir
+    beck.LOG_DIR = os.path.join(args.data_dir, "logs")
+    beck.ARCHIVE_DIR = os.path.join(args.data_dir, "archive")
+    beck.USAGE_FILE = beck.usage_file()
+    beck.ENTITY_INDEX_FILE = beck.entity_index_file()
+
+    conversations, turns = beck.compact_user_data(args.keep_turns, args.max_age_days)
+    failed = sum(v for (name, _), v in beck.metrics.counters.items() if name == "errors_total")
+    print(f"Archived {turns} turns from {conversations} conversations, {failed:g} failed.")
@@ -1,9 +1,255 @@
 import json
+import multiprocessing
+import queue
+import threading
+import time
 import tkinter as tk
+import tkinter.font as tkfont
 from tkinter import ttk, filedialog, messagebox, scrolledtext
 import os
 from datetime import datetime
 
+import analytics
+import beck
+
+INDEX_RESCAN_INTERVAL = 5.0   # seconds between mtime scans of the data dir
+SEARCH_DEBOUNCE_MS = 250
+
+class UserIndex:
+    # In-memory summary of every user file, built and kept fresh by a worker
+    # thread. A rescan only stats the directory and re-reads files whose
+    # mtime or size changed, so it stays cheap with tens of thousands of users.
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.entries = {}  # key -> ((mtime_ns, size), record)
+        self.version = 0
+        self.ordered = (-1, [])
+        self.last_search = (-1, "", [])
+
+    def scan(self):
+        # Builds a new dict and swaps it in, so readers never see a half-done scan
+        entries = {}
+        changed = False
+        try:
+            with os.scandir(self.data_dir) as it:
+                for entry in it:
+                    if not entry.name.endswith('.json') or not entry.is_file():
+                        continue
+                    key = entry.name[:-len('.json')]
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    signature = (st.st_mtime_ns, st.st_size)
+                    old = self.entries.get(key)
+                    if old and old[0] == signature:
+                        entries[key] = old
+                        continue
+                    record = self.read_record(entry.path, key)
+                    if record is None:
+                        if old:
+                            entries[key] = old
+                        continue
+                    entries[key] = (signature, record)
+                    changed = True
+        except FileNotFoundError:
+            pass
+        if changed or len(entries) != len(self.entries):
+            self.entries = entries
+            self.version += 1
+
+    def read_record(self, path, key):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        record = {
+            'key': key,
+            'username': data.get('username'),
+            'first_name': data.get('first_name'),
+            'last_name': data.get('last_name'),
+            'last_seen': data.get('last_seen'),
+            'message_count': data.get('message_count', 0),
+        }
+        record['search'] = " ".join(
+            str(record[field]) for field in ('key', 'username', 'first_name', 'last_name') if record[field]
+        ).lower()
+        return record
+
+    def search(self, term):
+        # Every word must match the key, username or name; most recent first
+        version, ordered = self.ordered
+        if version != self.version:
+            version = self.version
+            ordered = sorted((record for _, record in self.entries.values()),
+                             key=lambda r: r['last_seen'] or "", reverse=True)
+            self.ordered = (version, ordered)
+        term = term.lower()
+        # Typing narrows the previous result, so only filter that
+        last_version, last_term, last_results = self.last_search
+        if last_version == version and last_term and term.startswith(last_term):
+            results = last_results
+        else:
+            results = ordered
+        for word in term.split():
+            results = [r for r in results if word in r['search']]
+        self.last_search = (version, term, results)
+        return results
+
+class VirtualList(ttk.Frame):
+    # A Listbox that only ever holds the rows on screen. The scrollbar is
+    # driven by hand, so result sets of any size fill and scroll instantly.
+    def __init__(self, master, format_item, on_select):
+        super().__init__(master)
+        self.format_item = format_item
+        self.on_select = on_select
+        self.items = []
+        self.first = 0
+        self.selected_key = None
+        self.listbox = tk.Listbox(self, activestyle="none", exportselection=False)
+        self.scrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self.yview)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.row_height = tkfont.Font(font=self.listbox.cget("font")).metrics("linespace") + 1
+        self.listbox.bind("<<ListboxSelect>>", self.select)
+        self.listbox.bind("<Configure>", lambda e: self.render())
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            self.listbox.bind(sequence, self.wheel)
+        self.listbox.bind("<Up>", lambda e: self.step(-1))
+        self.listbox.bind("<Down>", lambda e: self.step(1))
+
+    def visible_rows(self):
+        return max(1, self.listbox.winfo_height() // self.row_height)
+
+    def set_items(self, items):
+        self.items = items
+        self.first = 0
+        self.render()
+
+    def render(self):
+        rows = self.visible_rows()
+        self.first = max(0, min(self.first, len(self.items) - rows))
+        window = self.items[self.first:self.first + rows]
+        self.listbox.delete(0, tk.END)
+        for i, item in enumerate(window):
+            self.listbox.insert(tk.END, self.format_item(item))
+            if item['key'] == self.selected_key:
+                self.listbox.selection_set(i)
+        total = len(self.items)
+        if total:
+            self.scrollbar.set(self.first / total, min(1.0, (self.first + rows) / total))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+    def yview(self, *args):
+        if args[0] == "moveto":
+            self.first = int(float(args[1]) * len(self.items))
+        elif args[0] == "scroll":
+            count = int(args[1])
+            self.first += count * (self.visible_rows() if args[2] == "pages" else 1)
+        self.render()
+
+    def wheel(self, event):
+        self.first += -3 if event.num == 4 or event.delta > 0 else 3
+        self.render()
+        return "break"
+
+    def step(self, delta):
+        # Keyboard navigation that scrolls the window at its edges
+        keys = [item['key'] for item in self.items]
+        index = keys.index(self.selected_key) + delta if self.selected_key in keys else 0
+        if 0 <= index < len(self.items):
+            if index < self.first:
+                self.first = index
+            elif index >= self.first + self.visible_rows():
+                self.first = index - self.visible_rows() + 1
+            self.selected_key = self.items[index]['key']
+            self.render()
+            self.on_select(self.items[index])
+        return "break"
+
+    def select(self, event=None):
+        selection = self.listbox.curselection()
+        if not selection or self.first + selection[0] >= len(self.items):
+            return
+        item = self.items[self.first + selection[0]]
+        self.selected_key = item['key']
+        self.on_select(item)
+
+
+MESSAGES_PAGE_SIZE = 200
+
+class ConversationLog:
+    # Random access to one conversation without parsing all of it. For a
+    # message log the byte offset of every line is indexed once (a single
+    # pass over the raw bytes), then pages are read by seeking. Old-style
+    # files that still hold their messages inline are served from memory.
+    def __init__(self, path=None, messages=None):
+        self.path = path
+        self.messages = messages
+        self.starts = []
+        self.size = 0
+        if path:
+            self.index_lines()
+
+    def __len__(self):
+        return len(self.messages) if self.messages is not None else len(self.starts)
+
+    def index_lines(self):
+        starts = [0]
+        position = 0
+        try:
+            with open(self.path, 'rb') as f:
+                while True:
+                    block = f.read(1 << 20)
+                    if not block:
+                        break
+                    i = block.find(b"\n")
+                    while i != -1:
+                        starts.append(position + i + 1)
+                        i = block.find(b"\n", i + 1)
+                    position += len(block)
+        except FileNotFoundError:
+            pass
+        # The last start is either the end of the file or a line still being written
+        self.size = starts.pop()
+        self.starts = starts
+
+    def read(self, start, end):
+        if self.messages is not None:
+            return self.messages[start:end]
+        if start >= end:
+            return []
+        stop = self.starts[end] if end < len(self.starts) else self.size
+        with open(self.path, 'rb') as f:
+            f.seek(self.starts[start])
+            lines = f.read(stop - self.starts[start]).splitlines()
+        return [self.parse(line) for line in lines]
+
+    def parse(self, line):
+        try:
+            return json.loads(line)
+        except ValueError:
+            # A corrupt line still takes its place, so indexes stay aligned
+            return {"from": "?", "text": "(unreadable line)"}
+
+    def find(self, term):
+        # Indexes of messages whose text contains term, oldest first
+        term = term.lower()
+        if self.messages is not None:
+            return [i for i, m in enumerate(self.messages) if term in str(m.get('text', '')).lower()]
+        matches = []
+        with open(self.path, 'rb') as f:
+            for i, line in enumerate(f):
+                if i >= len(self.starts):
+                    break
+                # Cheap test on the raw line first, then the text field only
+                if term in line.decode('utf-8', 'replace').lower() and \
+                        term in str(self.parse(line).get('text', '')).lower():
+                    matches.append(i)
+        return matches
+
 class UserDataViewer:
     def __init__(self, root):
         self.root = root
@@ -26,12 +272,14 @@ class UserDataViewer:
         self.search_var = tk.StringVar()
         self.search_entry = ttk.Entry(self.left_panel, textvariable=self.search_var)
         self.search_entry.pack(fill=tk.X, padx=5, pady=5)
-        self.search_entry.bind("<KeyRelease>", self.filter_list)
+        self.search_entry.bind("<KeyRelease>", self.schedule_filter)
+        self.search_job = None
         
-        # File list
-        self.file_listbox = tk.Listbox(self.left_panel)
-        self.file_listbox.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
-        self.file_listbox.bind("<<ListboxSelect>>", self.load_user_data)
+        # User list, filled from the index
+        self.user_list = VirtualList(self.left_panel, self.format_user, self.load_user_data)
+        self.user_list.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.status_label = ttk.Label(self.left_panel, text="Indexing...")
+        self.status_label.pack(fill=tk.X, padx=5)
         
         # Right panel - Data display
         self.right_panel = ttk.Frame(self.main_frame)
@@ -46,10 +294,21 @@ class UserDataViewer:
         self.create_activity_tab()
         self.create_messages_tab()
         self.create_entities_tab()
+        self.create_analytics_tab()
         
-        # Load initial data
-        self.data_dir = "user_data"
-        self.load_file_list()
+        # Index user files in the background
+        self.data_dir = beck.DATA_DIR
+        if not os.path.isdir(self.data_dir):
+            messagebox.showerror("Error", f"Directory '{self.data_dir}' not found!")
+        self.index = UserIndex(self.data_dir)
+        self.shown_version = -1
+        threading.Thread(target=self.index_loop, daemon=True).start()
+        self.poll_index()
+        
+        # Files for the selected user are parsed on worker threads
+        self.results = queue.Queue()
+        self.current_key = None
+        self.poll_results()
         
     def create_profile_tab(self):
         self.profile_frame = ttk.Frame(self.notebook)
@@ -79,6 +338,13 @@ class UserDataViewer:
         ttk.Label(self.profile_frame, text="Last Seen:").grid(row=5, column=0, sticky=tk.W)
         self.last_seen_label = ttk.Label(self.profile_frame, text="")
         self.last_seen_label.grid(row=5, column=1, sticky=tk.W)
+
+        ttk.Label(self.profile_frame, text="Blacklisted:").grid(row=6, column=0, sticky=tk.W)
+        self.blacklisted_label = ttk.Label(self.profile_frame, text="")
+        self.blacklisted_label.grid(row=6, column=1, sticky=tk.W)
+        self.ban_button = ttk.Button(self.profile_frame, text="Ban", command=self.toggle_ban, state=tk.DISABLED)
+        self.ban_button.grid(row=7, column=1, sticky=tk.W, pady=5)
+        self.current_user_id = None
         
     def create_activity_tab(self):
         self.activity_frame = ttk.Frame(self.notebook)
@@ -101,8 +367,31 @@ class UserDataViewer:
         self.messages_frame = ttk.Frame(self.notebook)
         self.notebook.add(self.messages_frame, text="Messages")
         
+        # In-conversation search
+        search_bar = ttk.Frame(self.messages_frame)
+        search_bar.pack(fill=tk.X, padx=5, pady=(5, 0))
+        self.find_var = tk.StringVar()
+        find_entry = ttk.Entry(search_bar, textvariable=self.find_var)
+        find_entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        find_entry.bind("<Return>", self.find_in_conversation)
+        ttk.Button(search_bar, text="Find", command=self.find_in_conversation).pack(side=tk.LEFT, padx=2)
+        ttk.Button(search_bar, text="◀", width=3, command=lambda: self.step_match(-1)).pack(side=tk.LEFT)
+        ttk.Button(search_bar, text="▶", width=3, command=lambda: self.step_match(1)).pack(side=tk.LEFT)
+        ttk.Button(search_bar, text="Archived", command=self.load_archive).pack(side=tk.LEFT, padx=2)
+        self.messages_status = ttk.Label(search_bar, text="")
+        self.messages_status.pack(side=tk.LEFT, padx=5)
+        
         self.messages_text = scrolledtext.ScrolledText(self.messages_frame, wrap=tk.WORD)
         self.messages_text.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.messages_text.configure(yscrollcommand=self.on_messages_scroll)
+        self.messages_text.tag_configure("match", background="yellow")
+        
+        # Only the messages in self.view = (first, end) are rendered
+        self.conversation = None
+        self.view = (0, 0)
+        self.page_loading = False
+        self.matches = []
+        self.match_pos = 0
         
     def create_entities_tab(self):
         self.entities_frame = ttk.Frame(self.notebook)
@@ -128,66 +417,400 @@ class UserDataViewer:
         self.mentions_listbox = tk.Listbox(self.entities_frame, height=3)
         self.mentions_listbox.pack(fill=tk.X, padx=5, pady=2)
         
-    def load_file_list(self):
-        self.file_listbox.delete(0, tk.END)
-        try:
-            files = [f for f in os.listdir(self.data_dir) if f.endswith('.json')]
-            for f in files:
-                self.file_listbox.insert(tk.END, f)
-        except FileNotFoundError:
-            messagebox.showerror("Error", f"Directory '{self.data_dir}' not found!")
-            
-    def filter_list(self, event=None):
-        search_term = self.search_var.get().lower()
-        self.file_listbox.delete(0, tk.END)
-        try:
-            files = [f for f in os.listdir(self.data_dir) 
-                    if f.endswith('.json') and search_term in f.lower()]
-            for f in files:
-                self.file_listbox.insert(tk.END, f)
-        except FileNotFoundError:
-            pass
-            
-    def load_user_data(self, event):
-        selection = self.file_listbox.curselection()
+        # Who used a hashtag or mention, across all users
+        ttk.Label(self.entities_frame, text="Who used (#hashtag or @mention):").pack(anchor=tk.W, pady=(10, 0))
+        who_bar = ttk.Frame(self.entities_frame)
+        who_bar.pack(fill=tk.X, padx=5, pady=2)
+        self.who_var = tk.StringVar()
+        who_entry = ttk.Entry(who_bar, textvariable=self.who_var)
+        who_entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        who_entry.bind("<Return>", self.find_who_used)
+        ttk.Button(who_bar, text="Find", command=self.find_who_used).pack(side=tk.LEFT, padx=2)
+        self.who_status = ttk.Label(who_bar, text="")
+        self.who_status.pack(side=tk.LEFT, padx=5)
+        self.who_listbox = tk.Listbox(self.entities_frame, height=8)
+        self.who_listbox.pack(fill=tk.BOTH, expand=True, padx=5, pady=2)
+        self.who_listbox.bind("<Double-Button-1>", self.open_who_result)
+        self.who_keys = []
+        
+    def create_analytics_tab(self):
+        self.analytics_frame = ttk.Frame(self.notebook)
+        self.notebook.add(self.analytics_frame, text="Analytics")
+        
+        # Totals over every conversation, computed by analytics.scan
+        toolbar = ttk.Frame(self.analytics_frame)
+        toolbar.pack(fill=tk.X, padx=5, pady=5)
+        self.analytics_button = ttk.Button(toolbar, text="Refresh", command=self.refresh_analytics)
+        self.analytics_button.pack(side=tk.LEFT)
+        self.analytics_status = ttk.Label(toolbar, text="Press Refresh to scan all users")
+        self.analytics_status.pack(side=tk.LEFT, padx=5)
+        
+        self.analytics_summary = ttk.Label(self.analytics_frame, text="", justify=tk.LEFT)
+        self.analytics_summary.pack(anchor=tk.W, padx=5)
+        
+        ttk.Label(self.analytics_frame, text="Messages per day (last 30 days):").pack(anchor=tk.W, padx=5)
+        self.per_day_canvas = tk.Canvas(self.analytics_frame, height=200, background="white")
+        self.per_day_canvas.pack(fill=tk.X, padx=5, pady=2)
+        
+        ttk.Label(self.analytics_frame, text="Top hashtags (users):").pack(anchor=tk.W, padx=5)
+        self.hashtags_canvas = tk.Canvas(self.analytics_frame, height=220, background="white")
+        self.hashtags_canvas.pack(fill=tk.X, padx=5, pady=2)
+        self.analytics_running = False
+        
+    def find_who_used(self, event=None):
+        term = self.who_var.get().strip().lower()
+        if not term:
+            return
+        kind = "mentions" if term.startswith("@") else "hashtags"
+        value = term.lstrip("#@")
+        self.who_status.config(text="Searching...")
+        self.run_in_background(lambda: self.read_who_used(kind, value), self.show_who_used)
+
+    def read_who_used(self, kind, value):
+        # Every journal of the bot's current layout, one per worker in multi-process mode
+        return beck.read_entity_index(beck.latest_entity_index_files()).lookup(kind, value)
+
+    def show_who_used(self, keys):
+        self.who_keys = keys
+        self.who_status.config(text=f"{len(keys)} users")
+        labels = []
+        for key in keys:
+            entry = self.index.entries.get(key)
+            labels.append(self.format_user(entry[1]) if entry else key)
+        self.update_listbox(self.who_listbox, labels)
+
+    def open_who_result(self, event=None):
+        selection = self.who_listbox.curselection()
         if not selection:
             return
+        entry = self.index.entries.get(self.who_keys[selection[0]])
+        if entry:
+            self.load_user_data(entry[1])
+
+    def index_loop(self):
+        # Worker thread: never touches Tk, the UI polls index.version instead
+        while True:
+            self.index.scan()
+            time.sleep(INDEX_RESCAN_INTERVAL)
+
+    def poll_index(self):
+        if self.index.version != self.shown_version:
+            self.shown_version = self.index.version
+            self.filter_list()
+        self.root.after(200, self.poll_index)
+
+    def schedule_filter(self, event=None):
+        # Debounced, so a burst of keystrokes costs a single search
+        if self.search_job:
+            self.root.after_cancel(self.search_job)
+        self.search_job = self.root.after(SEARCH_DEBOUNCE_MS, self.filter_list)
+
+    def filter_list(self):
+        self.search_job = None
+        results = self.index.search(self.search_var.get())
+        self.user_list.set_items(results)
+        self.status_label.config(text=f"{len(results)} of {len(self.index.entries)} users")
+
+    def format_user(self, record):
+        name = " ".join(n for n in (record['first_name'], record['last_name']) if n)
+        label = f"@{record['username']}" if record['username'] else name or record['key']
+        if record['username'] and name:
+            label += f" ({name})"
+        return f"{label}  [{record['key']}]"
             
-        filename = self.file_listbox.get(selection[0])
-        filepath = os.path.join(self.data_dir, filename)
-        
-        try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                
-            # Update profile tab
-            self.username_label.config(text=data.get('username', 'N/A'))
-            self.name_label.config(text=f"{data.get('first_name', '')} {data.get('last_name', '')}".strip() or 'N/A')
-            self.user_id_label.config(text=data.get('user_id', 'N/A'))
-            self.language_label.config(text=data.get('language_code', 'N/A'))
-            self.first_seen_label.config(text=self.format_timestamp(data.get('first_seen')))
-            self.last_seen_label.config(text=self.format_timestamp(data.get('last_seen')))
-            
-            # Update activity tab
-            self.total_messages_label.config(text=data.get('message_count', 0))
-            self.entities_label.config(text=data.get('entities_parsed', 0))
-            self.chat_type_label.config(text=data.get('chat_type', 'N/A'))
+    def run_in_background(self, work, done):
+        # Runs work() on a thread and hands its result to done() on the Tk thread
+        def run():
+            try:
+                result = work()
+            except Exception as e:
+                result = e
+            self.results.put((done, result))
+        threading.Thread(target=run, daemon=True).start()
+
+    def poll_results(self):
+        while True:
+            try:
+                done, result = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(result, Exception):
+                self.page_loading = False
+                self.analytics_running = False
+                self.analytics_button.config(state=tk.NORMAL)
+                messagebox.showerror("Error", f"Error loading file: {str(result)}")
+            else:
+                done(result)
+        self.root.after(50, self.poll_results)
+
+    def load_user_data(self, record):
+        # Parsing happens off the Tk thread; a newer selection makes this one stale
+        key = record['key']
+        self.current_key = key
+        self.run_in_background(lambda: self.read_user(key), lambda result: self.show_user(key, *result))
+
+    def read_user(self, key):
+        with open(os.path.join(self.data_dir, f"{key}.json"), 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        messages = data.get('messages')
+        if messages is None:
+            conversation = ConversationLog(path=os.path.join(self.data_dir, "logs", f"{key}.jsonl"))
+        else:
+            conversation = ConversationLog(messages=messages)
+        end = len(conversation)
+        start = max(0, end - MESSAGES_PAGE_SIZE)
+        return data, conversation, start, conversation.read(start, end)
+
+    def update_ban_status(self):
+        # The bot notices blacklist.json changes within BLACKLIST_CHECK_INTERVAL
+        beck.blacklist.refresh()
+        banned = beck.is_blacklisted(self.current_user_id)
+        self.blacklisted_label.config(text="Yes" if banned else "No")
+        self.ban_button.config(text="Unban" if banned else "Ban",
+                               state=tk.NORMAL if self.current_user_id is not None else tk.DISABLED)
+
+    def toggle_ban(self):
+        if self.current_user_id is None:
+            return
+        if beck.is_blacklisted(self.current_user_id):
+            beck.blacklist.remove(self.current_user_id)
+        elif messagebox.askyesno("Ban user", f"Ban user {self.current_user_id}?"):
+            beck.blacklist.add(self.current_user_id)
+        self.update_ban_status()
+
+    def load_archive(self):
+        # Archived turns are only read when asked for, then shown ahead of the live log
+        key = self.current_key
+        if key is None:
+            return
+        self.messages_status.config(text="Loading archived history...")
+        self.run_in_background(lambda: self.read_archive(key), lambda result: self.show_archive(key, *result))
+
+    def read_archive(self, key):
+        archived = beck.read_archived_messages(key)
+        _, live, _, _ = self.read_user(key)
+        conversation = ConversationLog(messages=archived + live.read(0, len(live)))
+        end = len(conversation)
+        start = max(0, end - MESSAGES_PAGE_SIZE)
+        return len(archived), conversation, start, conversation.read(start, end)
+
+    def show_archive(self, key, archived, conversation, start, page):
+        if key != self.current_key:
+            return
+        self.conversation = conversation
+        self.matches = []
+        self.page_loading = False
+        self.show_window(start, page)
+        self.messages_text.see(tk.END)
+        if not archived:
+            self.messages_status.config(text="No archived history")
+
+    def show_user(self, key, data, conversation, start, page):
+        if key != self.current_key:
+            return
             
-            # Update messages tab
-            self.messages_text.delete(1.0, tk.END)
-            for msg in data.get('messages', []):
-                timestamp = self.format_timestamp(msg.get('timestamp'))
-                self.messages_text.insert(tk.END, 
-                    f"[{timestamp}] {msg.get('from', '?')}: {msg.get('text', '')}\n")
-                
-            # Update entities tab
-            self.update_listbox(self.links_listbox, data.get('links', []))
-            self.update_listbox(self.phones_listbox, data.get('phone_numbers', []))
-            self.update_listbox(self.hashtags_listbox, [f"#{h}" for h in data.get('hashtags', [])])
-            self.update_listbox(self.mentions_listbox, [f"@{m}" for m in data.get('mentions', [])])
+        # Update profile tab
+        self.username_label.config(text=data.get('username', 'N/A'))
+        self.name_label.config(text=f"{data.get('first_name', '')} {data.get('last_name', '')}".strip() or 'N/A')
+        self.user_id_label.config(text=data.get('user_id', 'N/A'))
+        self.language_label.config(text=data.get('language_code', 'N/A'))
+        self.first_seen_label.config(text=self.format_timestamp(data.get('first_seen')))
+        self.last_seen_label.config(text=self.format_timestamp(data.get('last_seen')))
+        self.current_user_id = data.get('user_id')
+        self.update_ban_status()
+        
+        # Update activity tab
+        self.total_messages_label.config(text=data.get('message_count', 0))
+        self.entities_label.config(text=data.get('entities_parsed', 0))
+        self.chat_type_label.config(text=data.get('chat_type', 'N/A'))
+        
+        # Update messages tab, newest page only
+        self.conversation = conversation
+        self.matches = []
+        self.page_loading = False
+        self.show_window(start, page)
+        self.messages_text.see(tk.END)
             
-        except Exception as e:
-            messagebox.showerror("Error", f"Error loading file: {str(e)}")
+        # Update entities tab
+        self.update_listbox(self.links_listbox, data.get('links', []))
+        self.update_listbox(self.phones_listbox, data.get('phone_numbers', []))
+        self.update_listbox(self.hashtags_listbox, [f"#{h}" for h in data.get('hashtags', [])])
+        self.update_listbox(self.mentions_listbox, [f"@{m}" for m in data.get('mentions', [])])
+
+    def refresh_analytics(self):
+        if self.analytics_running:
+            return
+        self.analytics_running = True
+        self.analytics_button.config(state=tk.DISABLED)
+        self.analytics_status.config(text="Scanning...")
+        
+        def progress(done, total):
+            # Called on the worker thread, shown by poll_results
+            self.results.put((self.show_analytics_progress, (done, total)))
+        
+        def work():
+            start = time.perf_counter()
+            # Forking a process that runs Tk threads is unsafe, so spawn the pool
+            partials, stats = analytics.scan(self.data_dir, mp_context=multiprocessing.get_context("spawn"),
+                                             progress=progress)
+            return analytics.aggregate(partials), stats, time.perf_counter() - start
+        self.run_in_background(work, lambda result: self.show_analytics(*result))
+
+    def show_analytics_progress(self, progress):
+        done, total = progress
+        if self.analytics_running:
+            self.analytics_status.config(text=f"Scanning... {done}/{total} changed files")
+
+    def show_analytics(self, totals, stats, elapsed):
+        self.analytics_running = False
+        self.analytics_button.config(state=tk.NORMAL)
+        self.analytics_status.config(
+            text=f"{stats['files']} conversations in {elapsed:.1f}s ({stats['reprocessed']} reprocessed)")
+        self.analytics_summary.config(text=(
+            f"Users: {totals['users']}    Active this week: {totals['active_this_week']}    "
+            f"Conversations: {totals['conversations']}\n"
+            f"Messages: {totals['messages']}    Average history: {totals['average_history']:.1f} messages"))
+        self.draw_bars(self.per_day_canvas, [(day[5:], n) for day, n in totals['messages_per_day']])
+        self.draw_bars(self.hashtags_canvas, [(f"#{tag}", n) for tag, n in totals['top_hashtags']],
+                       horizontal=True)
+
+    def draw_bars(self, canvas, items, horizontal=False):
+        canvas.delete("all")
+        canvas.update_idletasks()
+        width, height = canvas.winfo_width(), int(canvas.cget("height"))
+        largest = max((n for _, n in items), default=0)
+        if not largest:
+            canvas.create_text(width // 2, height // 2, text="No data")
+            return
+        if horizontal:
+            # One row per item: label, bar, count
+            row = (height - 10) / len(items)
+            for i, (label, n) in enumerate(items):
+                y = 5 + i * row
+                length = (width - 220) * n / largest
+                canvas.create_text(5, y + row / 2, text=label, anchor=tk.W)
+                canvas.create_rectangle(140, y + 2, 140 + length, y + row - 2, fill="steelblue", outline="")
+                canvas.create_text(145 + length, y + row / 2, text=str(n), anchor=tk.W)
+        else:
+            # One column per item, labels under every few columns
+            column = (width - 10) / len(items)
+            label_every = max(1, int(40 // column) + 1)
+            for i, (label, n) in enumerate(items):
+                x = 5 + i * column
+                top = 15 + (height - 40) * (1 - n / largest)
+                canvas.create_rectangle(x + 1, top, x + column - 1, height - 25, fill="steelblue", outline="")
+                if i % label_every == 0:
+                    canvas.create_text(x + column / 2, height - 12, text=label)
+            canvas.create_text(5, 5, text=f"max {largest}", anchor=tk.NW)
+
+    def insert_messages(self, index, start, messages):
+        # One insert call per page; each message is tagged msg<N> so it can be found again
+        chunks = []
+        for i, msg in enumerate(messages, start):
+            timestamp = self.format_timestamp(msg.get('timestamp'))
+            chunks += [f"[{timestamp}] {msg.get('from', '?')}: {msg.get('text', '')}\n", (f"msg{i}",)]
+        if chunks:
+            self.messages_text.insert(index, *chunks)
+
+    def show_window(self, start, messages):
+        self.messages_text.delete(1.0, tk.END)
+        self.insert_messages(tk.END, start, messages)
+        self.view = (start, start + len(messages))
+        self.update_messages_status()
+
+    def update_messages_status(self):
+        first, end = self.view
+        text = f"Messages {first + 1}-{end} of {len(self.conversation)}" if end else "No messages"
+        if self.matches:
+            text += f"  |  match {self.match_pos + 1} of {len(self.matches)}"
+        self.messages_status.config(text=text)
+
+    def on_messages_scroll(self, first, last):
+        self.messages_text.vbar.set(first, last)
+        if self.conversation is None or self.page_loading:
+            return
+        start, end = self.view
+        if float(first) <= 0.0 and start > 0:
+            self.load_page(max(0, start - MESSAGES_PAGE_SIZE), start)
+        elif float(last) >= 1.0 and end < len(self.conversation):
+            self.load_page(end, min(len(self.conversation), end + MESSAGES_PAGE_SIZE))
+
+    def load_page(self, start, end):
+        key, conversation = self.current_key, self.conversation
+        self.page_loading = True
+        self.run_in_background(lambda: conversation.read(start, end),
+                               lambda page: self.add_page(key, start, page))
+
+    def add_page(self, key, start, page):
+        self.page_loading = False
+        if key != self.current_key:
+            return
+        first, end = self.view
+        if start < first:
+            # Prepend and keep the same line at the top of the view
+            top_line = int(self.messages_text.index("@0,0").split(".")[0])
+            lines_before = int(self.messages_text.index("end-1c").split(".")[0])
+            self.insert_messages("1.0", start, page)
+            lines_added = int(self.messages_text.index("end-1c").split(".")[0]) - lines_before
+            self.messages_text.yview(f"{top_line + lines_added}.0")
+            self.view = (start, end)
+        else:
+            self.insert_messages(tk.END, start, page)
+            self.view = (first, start + len(page))
+        self.update_messages_status()
+
+    def find_in_conversation(self, event=None):
+        term = self.find_var.get().strip()
+        if not term or self.conversation is None:
+            return
+        key, conversation = self.current_key, self.conversation
+        self.run_in_background(lambda: conversation.find(term),
+                               lambda matches: self.show_matches(key, matches))
+
+    def show_matches(self, key, matches):
+        if key != self.current_key:
+            return
+        self.matches = matches
+        if not matches:
+            self.messages_text.tag_remove("match", 1.0, tk.END)
+            self.update_messages_status()
+            self.messages_status.config(text=self.messages_status.cget("text") + "  |  no matches")
+            return
+        # Start from the newest match, like the view itself
+        self.match_pos = len(matches) - 1
+        self.jump_to_match()
+
+    def step_match(self, delta):
+        if self.matches:
+            self.match_pos = (self.match_pos + delta) % len(self.matches)
+            self.jump_to_match()
+
+    def jump_to_match(self):
+        index = self.matches[self.match_pos]
+        first, end = self.view
+        if first <= index < end:
+            self.highlight_message(index)
+            return
+        # Render one page around the match instead of everything in between
+        start = max(0, index - MESSAGES_PAGE_SIZE // 2)
+        stop = min(len(self.conversation), start + MESSAGES_PAGE_SIZE)
+        key, conversation = self.current_key, self.conversation
+        self.page_loading = True
+
+        def show(page):
+            self.page_loading = False
+            if key == self.current_key:
+                self.show_window(start, page)
+                self.highlight_message(index)
+        self.run_in_background(lambda: conversation.read(start, stop), show)
+
+    def highlight_message(self, index):
+        self.messages_text.tag_remove("match", 1.0, tk.END)
+        ranges = self.messages_text.tag_ranges(f"msg{index}")
+        if ranges:
+            self.messages_text.tag_add("match", ranges[0], ranges[1])
+            self.messages_text.see(ranges[0])
+        self.update_messages_status()
             
     def format_timestamp(self, ts):
         try:
@@ -0,0 +1,32 @@
+import argparse
+import glob
+import os
+
+import beck
+
+# Converts old-style user_data/*.json files, which keep the whole history in
+# a "messages" list, into a profile file plus an append-only log in
+# user_data/logs/. Stop the bot first; files already converted are skipped.
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move message history out of user_data/*.json into logs")
+    parser.add_argument("--data-dir", default=beck.DATA_DIR)
+    args = parser.parse_args()
+
+    beck.DATA_DIR = args.data_dir
+    beck.LOG_DIR = os.path.join(args.data_dir, "logs")
+    beck.USAGE_FILE = beck.usage_file()
+    beck.ENTITY_INDEX_FILE = beck.entity_index_file()
+
+    converted = skipped = failed = 0
+    for path in sorted(glob.glob(os.path.join(args.data_dir, "*.json"))):
+        try:
+            if beck.migrate_user_file(path):
+                converted += 1
+            else:
+                skipped += 1
+        except Exception as e:
+            print(f"Failed to convert {path}: {e}")
+            failed += 1
+
+    print(f"Converted {converted} files, {skipped} already converted, {failed} failed.")